@@ -0,0 +1,112 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+
+from . import benchmark
+from .benchmark import BenchmarkError
+from directions import directions
+import argparse
+import json
+import os
+import sys
+
+REGRESSION_TOLERANCE = 1.5
+# Differences in p99 latency smaller than this many seconds aren't
+# regressions, however large they are relative to the baseline.
+REGRESSION_SLACK = 0.002
+
+
+def parse_list(type):
+    def parse(value):
+        return [type(item) for item in value.split(",")]
+    return parse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m benchmark")
+    parser.add_argument(
+        "-f", "--formats", type=parse_list(str), default=["json", "binary"],
+        help="comma-separated payload formats (default: json,binary)",
+    )
+    parser.add_argument(
+        "-r", "--rates", type=parse_list(float), default=[10, 50, 200],
+        help="comma-separated sample rates in Hz (default: 10,50,200)",
+    )
+    parser.add_argument(
+        "-d", "--duration", type=float, default=5,
+        help="seconds to run each case (default: 5)",
+    )
+    parser.add_argument(
+        "--direction-rate", type=float, default=5,
+        help="immediate directions requested per second (default: 5)",
+    )
+    parser.add_argument(
+        "-o", "--output", help="write the results to this JSON file",
+    )
+    parser.add_argument(
+        "-b", "--baseline",
+        help="fail if p99 latencies are much worse than in this JSON file",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=REGRESSION_TOLERANCE,
+        help="allowed ratio to the baseline p99 (default: {})".format(
+            REGRESSION_TOLERANCE,
+        ),
+    )
+    args = parser.parse_args()
+    for fmt in args.formats:
+        if fmt not in ["json", "binary"]:
+            parser.error("unknown format: {}".format(fmt))
+    return args
+
+
+def main():
+    args = parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    with open(os.devnull, "w") as f:
+        directions.set_log_file(f)
+        try:
+            results = benchmark.run(
+                args.formats, args.rates, args.duration, args.direction_rate,
+            )
+        except BenchmarkError as e:
+            print("Error: {}".format(e), file=sys.stderr)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        directions.set_log_file(None)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline is None:
+        return
+    regressions = benchmark.find_regressions(
+        results, baseline, args.tolerance, REGRESSION_SLACK,
+    )
+    for regression in regressions:
+        print("Regression: {}".format(regression), file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Measures how long sensor samples take to get through each stage of the
+# pipeline: from termux-sensor (fake_sensor.py) through sensors.Client, over
+# TCP on localhost into SensorServer, and from the navigator's output into the
+# speech process (fake_tts.py). The client, server and navigator are the
+# real ones, running in this process.
+
+from directions import directions
+from directions.directions import Navigator, SensorConnection, SensorServer
+from sensors import sensors
+from sensors.config import MAGNETOMETER, GRAVITY
+from sensors.parser import FrameParser
+from sensors.protocol import DEFAULT_SESSION, FRAME, SENSOR_IDS
+from sensors.protocol import VERSION_BINARY
+import asyncio
+import json
+import numpy as np
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..")
+BIN_DIR = os.path.join(os.path.dirname(__file__), "bin")
+READY_TIMEOUT = 10
+
+STAGES = [
+    ("sensor", "termux-sensor to client send"),
+    ("network", "client send to server"),
+    ("process", "server processing (per batch)"),
+    ("speech", "output to speech"),
+    ("total", "newest sample to speech"),
+]
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+# Records the time of every write to a sensor client's connection.
+class TracingWriter:
+    def __init__(self, writer):
+        self.writer = writer
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append((time.time(), data))
+        self.writer.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+class TracingClient(sensors.Client):
+    async def find_ip(self):
+        return "127.0.0.1"
+
+    async def negotiate(self):
+        await super().negotiate()
+        self.writer = TracingWriter(self.writer)
+
+    # Returns a dict that maps the sequence number of each sample that was
+    # sent to the time at which it was sent.
+    def sent_samples(self):
+        times = {}
+        writes = getattr(self.writer, "writes", [])
+        if self.version == VERSION_BINARY:
+            magnetometer = SENSOR_IDS[MAGNETOMETER]
+            for t, data in writes:
+                for frame in FRAME.iter_unpack(data):
+                    if frame[1] == magnetometer:
+                        times[int(frame[-1])] = t
+            return times
+        parser = FrameParser([MAGNETOMETER, GRAVITY])
+        for t, data in writes:
+            for record in parser.feed(data):
+                times[int(record[MAGNETOMETER][2])] = t
+        return times
+
+
+class TracingConnection(SensorConnection):
+    def process_records(self, records):
+        start = time.time()
+        count = super().process_records(records)
+        end = time.time()
+        seqs = [
+            int(data[MAGNETOMETER][2]) for data in records
+            if MAGNETOMETER in data
+        ]
+        self.server.batches.append((start, end, seqs))
+        if seqs:
+            self.server.newest = max(self.server.newest, max(seqs))
+        return count
+
+
+class TracingServer(SensorServer):
+    connection_class = TracingConnection
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+        self.newest = -1
+
+
+# Records the time at which each line is written, along with the newest
+# sample the server had processed at that time.
+class TracingOutput:
+    def __init__(self, file, server):
+        self.file = file
+        self.server = server
+        self.lines = []
+
+    def write(self, data):
+        now = time.time()
+        for _ in range(data.count("\n")):
+            self.lines.append((now, self.server.newest))
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def summarize(latencies):
+    if not latencies:
+        return None
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {"count": len(latencies), "p50": p50, "p99": p99}
+
+
+async def wait_for(condition, timeout):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise BenchmarkError("Timed out")
+        await asyncio.sleep(0.01)
+
+
+# Runs the pipeline for `duration` seconds with termux-sensor producing
+# `rate` samples per second, sent in the given format ("json" or "binary").
+# An immediate direction is requested `direction_rate` times per second.
+async def run_case(fmt, rate, duration, direction_rate, trace_dir):
+    sensor_trace = os.path.join(trace_dir, "sensor.json")
+    tts_trace = os.path.join(trace_dir, "tts.json")
+    port = free_port()
+    directions.PORT = port
+    sensors.PORT = port
+    sensors.PROTOCOL = fmt
+    os.environ["BENCHMARK_RATE"] = str(rate)
+    os.environ["BENCHMARK_TRACE"] = sensor_trace
+
+    tts = subprocess.Popen(
+        [sys.executable, "-m", "benchmark.fake_tts", tts_trace],
+        stdin=subprocess.PIPE, encoding="utf8", bufsize=1,
+    )
+    server = TracingServer()
+    output = TracingOutput(tts.stdin, server)
+    session = server.session(DEFAULT_SESSION)
+    navigator = Navigator(session, output=output, persist=False, echo=False)
+    tasks = [asyncio.ensure_future(server.start())]
+    client_task = None
+    try:
+        await wait_for(lambda: server.server is not None, READY_TIMEOUT)
+        tasks.append(asyncio.ensure_future(navigator.start()))
+        client = TracingClient()
+        if not await client.try_establish_connection():
+            raise BenchmarkError("Could not connect to server")
+        client_task = asyncio.ensure_future(client.read_sensors())
+        await wait_for(session.ready.is_set, READY_TIMEOUT)
+
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            navigator.commands.put_nowait("")
+            await asyncio.sleep(1 / direction_rate)
+    finally:
+        # Stopping the client hangs up on the sensor process, which then
+        # writes its trace.
+        if client_task is not None:
+            client_task.cancel()
+            await asyncio.gather(client_task, return_exceptions=True)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        tts.stdin.close()
+        tts.wait()
+
+    try:
+        with open(sensor_trace) as f:
+            emitted = json.load(f)
+        with open(tts_trace) as f:
+            spoken = json.load(f)
+    except (OSError, ValueError) as e:
+        raise BenchmarkError("Missing trace: {}".format(e))
+    sent = client.sent_samples()
+
+    stages = {name: [] for name, _ in STAGES}
+    stages["sensor"] = [
+        t - emitted[seq] for seq, t in sent.items() if seq < len(emitted)
+    ]
+    received = 0
+    for start, end, seqs in server.batches:
+        stages["process"].append(end - start)
+        received += len(seqs)
+        stages["network"] += [start - sent[seq] for seq in seqs if seq in sent]
+    for (emit_time, newest), speech_time in zip(output.lines, spoken):
+        stages["speech"].append(speech_time - emit_time)
+        if 0 <= newest < len(emitted):
+            stages["total"].append(speech_time - emitted[newest])
+
+    throughput = 0
+    if len(server.batches) > 1:
+        elapsed = server.batches[-1][1] - server.batches[0][0]
+        throughput = received / elapsed
+    return {
+        "format": fmt,
+        "rate": rate,
+        "emitted": len(emitted),
+        "received": received,
+        "throughput": throughput,
+        "stages": {
+            name: summarize(latencies) for name, latencies in stages.items()
+        },
+    }
+
+
+def run(formats, rates, duration, direction_rate):
+    os.environ["PATH"] = BIN_DIR + os.pathsep + os.environ["PATH"]
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [ROOT_DIR, os.environ.get("PYTHONPATH")]),
+    )
+    loop = asyncio.get_event_loop()
+    results = []
+    for fmt in formats:
+        for rate in rates:
+            with tempfile.TemporaryDirectory() as trace_dir:
+                result = loop.run_until_complete(run_case(
+                    fmt, rate, duration, direction_rate, trace_dir,
+                ))
+            print_result(result)
+            results.append(result)
+    return results
+
+
+def print_result(result):
+    print("{}, {:g} Hz: {} of {} samples received, {:.1f} per second".format(
+        result["format"], result["rate"], result["received"],
+        result["emitted"], result["throughput"],
+    ))
+    print("  {:<32} {:>9} {:>9}".format("stage", "p50 (ms)", "p99 (ms)"))
+    for name, description in STAGES:
+        stats = result["stages"][name]
+        if stats is None:
+            print("  {:<32} {:>9} {:>9}".format(description, "-", "-"))
+            continue
+        print("  {:<32} {:>9.2f} {:>9.2f}".format(
+            description, stats["p50"] * 1000, stats["p99"] * 1000,
+        ))
+    print()
+
+
+# Returns a description of every stage whose p99 latency is more than
+# `tolerance` times (and at least `slack` seconds more than) its p99 in
+# `baseline`.
+def find_regressions(results, baseline, tolerance, slack):
+    baseline = {(r["format"], r["rate"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get((result["format"], result["rate"]))
+        if old is None:
+            continue
+        for name, _ in STAGES:
+            new_stats = result["stages"][name]
+            old_stats = old["stages"].get(name)
+            if new_stats is None or old_stats is None:
+                continue
+            limit = max(old_stats["p99"] * tolerance, old_stats["p99"] + slack)
+            if new_stats["p99"] > limit:
+                regressions.append(
+                    "{}, {:g} Hz, {}: p99 {:.2f} ms (was {:.2f} ms)".format(
+                        result["format"], result["rate"], name,
+                        new_stats["p99"] * 1000, old_stats["p99"] * 1000,
+                    ),
+                )
+    return regressions
@@ -0,0 +1,81 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+
+# Stands in for termux-sensor. Prints magnetometer and gravity samples in
+# the same format at BENCHMARK_RATE samples per second. The z component of
+# each magnetometer sample is its sequence number, so the sample can be
+# followed through the rest of the pipeline. The time at which each sample
+# was printed is written to BENCHMARK_TRACE when the process is hung up on.
+
+from sensors.config import MAGNETOMETER, GRAVITY
+import json
+import math
+import os
+import signal
+import sys
+import time
+
+GRAVITY_VALUES = [0.0, 0.0, 9.81]
+MAGNETISM = 40
+
+
+def sample(seq):
+    angle = seq * 0.01
+    return {
+        MAGNETOMETER: {"values": [
+            MAGNETISM * math.cos(angle), MAGNETISM * math.sin(angle), seq,
+        ]},
+        GRAVITY: {"values": GRAVITY_VALUES},
+    }
+
+
+def run(rate, trace_path):
+    times = []
+
+    def finish(*args):
+        with open(trace_path, "w") as f:
+            json.dump(times, f)
+        sys.exit(0)
+
+    signal.signal(signal.SIGHUP, finish)
+    signal.signal(signal.SIGTERM, finish)
+    start = time.time()
+    seq = 0
+    while True:
+        delay = start + seq / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        data = json.dumps(sample(seq), indent=2) + "\n"
+        times.append(time.time())
+        sys.stdout.write(data)
+        sys.stdout.flush()
+        seq += 1
+
+
+def main():
+    # Cleanup request ("termux-sensor -c").
+    if "-c" in sys.argv[1:]:
+        return
+    try:
+        run(float(os.environ["BENCHMARK_RATE"]), os.environ["BENCHMARK_TRACE"])
+    except BrokenPipeError:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-#!/usr/bin/env python3
 # Copyright (C) 2019 taylor.fish <contact@taylor.fish>
 #
 # This file is part of random-directions.
@@ -16,30 +15,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with random-directions. If not, see <https://www.gnu.org/licenses/>.
 
-import cgi
-import os
 
-SCRIPT_DIR = os.path.dirname(__file__)
-DEST = os.path.join(SCRIPT_DIR, "index.txt")
+# Stands in for the speech process. Reads lines from standard input and,
+# at EOF, writes the time at which each line was received to the file given
+# as the first argument.
 
-
-def set_ip(ip):
-    with open(DEST, "w", encoding="utf8") as f:
-        print(ip, file=f)
+import json
+import sys
+import time
 
 
 def main():
-    print("Content-Type: text/plain\n")
-    if os.environ["REQUEST_METHOD"] == "POST":
-        form = cgi.FieldStorage()
-        if "ip" in form:
-            ip = form.getfirst("ip")
-            set_ip(ip)
-            print("Success")
-            return
-        print("Error: 'ip' parameter was not provided.")
-        return
-    print("Cannot GET this URL.")
+    times = []
+    for line in sys.stdin:
+        times.append(time.time())
+    with open(sys.argv[1], "w") as f:
+        json.dump(times, f)
 
 
 if __name__ == "__main__":
@@ -16,7 +16,8 @@
 # along with random-directions. If not, see <https://www.gnu.org/licenses/>.
 
 from . import directions
-from .directions import CACHE_DIR, log
+from .directions import CACHE_DIR, fixed_messages, log
+from .speech import SPEAK, AudioCache, SpeechOutput
 import os
 import sys
 import traceback
@@ -24,11 +25,19 @@ import traceback
 LOG_PATH = os.path.join(CACHE_DIR, "directions.log")
 
 
+def run():
+    if not SPEAK:
+        directions.run()
+        return
+    output = SpeechOutput(AudioCache(), fixed_messages())
+    directions.run(output=output, tasks=[output.run()])
+
+
 def main():
     with open(LOG_PATH, "a", encoding="utf8") as f:
         directions.set_log_file(f)
         try:
-            directions.run()
+            run()
         except (KeyboardInterrupt, EOFError):
             sys.exit(0)
         except Exception:
@@ -0,0 +1,163 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Capture files hold the decoded records received on one sensor connection,
+# as fixed-size binary records following a short header. Captures are
+# memory-mapped when replayed, so even very long ones open immediately.
+
+from . import clock
+from sensors.protocol import SENSOR_IDS, TIMESTAMP
+import asyncio
+import numpy as np
+import struct
+
+MAGIC = b"RDCP"
+VERSION = 2
+# Magic, version, number of sensor slots, padding. Version 1 captures have
+# no slot count, and always have V1_SLOTS slots.
+HEADER = struct.Struct("<4sBB2x")
+V1_SLOTS = 3
+SLOTS = len(SENSOR_IDS)
+
+
+# `time` is the local monotonic time at which the record was received, so
+# records received together share the same time. `timestamp` is the
+# client's timestamp, or NaN if it didn't send one. Bit i of `sensors` is
+# set if `values[i]` holds data for the sensor with ID i + 1. Sensors with
+# IDs greater than `slots` can't be stored.
+def record_dtype(slots):
+    return np.dtype([
+        ("time", "<f8"),
+        ("timestamp", "<f8"),
+        ("sensors", "u1"),
+        ("values", "<f4", (slots, 3)),
+    ])
+
+
+RECORD = record_dtype(SLOTS)
+
+
+class CaptureError(Exception):
+    pass
+
+
+def encode_records(records, time):
+    rows = np.zeros(len(records), dtype=RECORD)
+    rows["time"] = time
+    for row, data in zip(rows, records):
+        row["timestamp"] = data.get(TIMESTAMP, np.nan)
+        for name, id in SENSOR_IDS.items():
+            values = data.get(name)
+            # Invalid data is dropped, just as it would be when processed.
+            if values is None or len(values) != 3:
+                continue
+            row["sensors"] |= 1 << (id - 1)
+            row["values"][id - 1] = values
+    return rows
+
+
+def decode_record(row):
+    data = {}
+    sensors = int(row["sensors"])
+    slots = len(row["values"])
+    for name, id in SENSOR_IDS.items():
+        if id <= slots and sensors & (1 << (id - 1)):
+            data[name] = tuple(map(float, row["values"][id - 1]))
+    timestamp = float(row["timestamp"])
+    if not np.isnan(timestamp):
+        data[TIMESTAMP] = timestamp
+    return data
+
+
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "xb", buffering=0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, SLOTS))
+
+    # Every batch is written immediately, so little is lost if the process
+    # crashes.
+    def write(self, records, time):
+        if records:
+            self.file.write(encode_records(records, time).tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+class Capture:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            f.seek(0, 2)
+            size = f.tell()
+        if len(header) < HEADER.size:
+            raise CaptureError("Capture file is too short")
+        magic, version, slots = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise CaptureError("Not a capture file")
+        if version == 1:
+            slots = V1_SLOTS
+        elif version != VERSION:
+            raise CaptureError("Unsupported capture version: {}".format(
+                version,
+            ))
+        if not 0 < slots <= 8:
+            raise CaptureError("Invalid number of sensors: {}".format(slots))
+        dtype = record_dtype(slots)
+        # A record that was only partly written is ignored.
+        count = (size - HEADER.size) // dtype.itemsize
+        if count == 0:
+            self.records = np.zeros(0, dtype=dtype)
+            return
+        self.records = np.memmap(
+            path, dtype=dtype, mode="r", offset=HEADER.size, shape=(count,),
+        )
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def duration(self):
+        if len(self.records) == 0:
+            return 0
+        return float(self.records["time"][-1] - self.records["time"][0])
+
+    # Yields (time, records) for each batch of records that were received
+    # together, with times relative to the first batch.
+    def batches(self):
+        if len(self.records) == 0:
+            return
+        times = self.records["time"]
+        starts = np.flatnonzero(np.diff(times)) + 1
+        bounds = np.concatenate([[0], starts, [len(times)]])
+        start_time = times[0]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield float(times[start] - start_time), [
+                decode_record(row) for row in self.records[start:end]
+            ]
+
+    # Feeds the capture into `connection` (usually a SensorConnection), with
+    # the original timing divided by `speed`.
+    async def replay(self, connection, speed=1):
+        start = clock.now()
+        for time, records in self.batches():
+            delay = start + time / speed - clock.now()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            connection.process_records(records)
@@ -0,0 +1,74 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import selectors
+import time
+
+
+# The time according to the running event loop, which is virtual time when
+# running in a VirtualTimeLoop.
+def now():
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return time.monotonic()
+    return loop.time()
+
+
+# Time as seen by the navigator. With a speedup of N, every duration passes
+# N times faster than normal.
+class Clock:
+    def __init__(self, speedup=1):
+        self.speedup = speedup
+
+    def monotonic(self):
+        return now() * self.speedup
+
+    async def sleep(self, duration):
+        await asyncio.sleep(duration / self.speedup)
+
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    # Instead of waiting for the next timer, jump straight to it, unless
+    # there is I/O that is ready right now.
+    def select(self, timeout=None):
+        if timeout is None:
+            return super().select(timeout)
+        events = super().select(0)
+        if not events and timeout > 0:
+            self.loop.advance(timeout)
+        return events
+
+
+# Event loop in which time passes only when every task is waiting for a
+# timer, so sleeps finish immediately in real time. Intended for
+# simulations without real I/O.
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.virtual_time = 0.0
+        super().__init__(VirtualTimeSelector(self))
+
+    def time(self):
+        return self.virtual_time
+
+    def advance(self, duration):
+        self.virtual_time += duration
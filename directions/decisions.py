@@ -0,0 +1,84 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+# Scores actions for any number of (target direction, current direction)
+# pairs at once. The rotation for each action is computed once, up front.
+class DecisionEngine:
+    def __init__(
+            self, actions, angles, multipliers, base_weight,
+            helpfulness_offset, helpfulness_power):
+        self.actions = list(actions)
+        self.indices = {action: i for i, action in enumerate(self.actions)}
+        # Indices of the subsets of actions that have been selected.
+        self.selections = {}
+        angles = np.array([angles[action] for action in self.actions])
+        cos, sin = np.cos(angles), np.sin(angles)
+        # Same rotations as `Orientation.new_rot_z`, restricted to the xy
+        # plane: shape (actions, 2, 2).
+        self.rotations = np.stack([
+            np.stack([cos, -sin], axis=-1),
+            np.stack([sin, cos], axis=-1),
+        ], axis=1)
+        self.multipliers = np.array([
+            multipliers[action] for action in self.actions
+        ])
+        self.base_weight = base_weight
+        self.helpfulness_offset = helpfulness_offset
+        self.helpfulness_power = helpfulness_power
+
+    def select(self, actions):
+        key = tuple(actions)
+        indices = self.selections.get(key)
+        if indices is None:
+            indices = np.array([self.indices[action] for action in actions])
+            self.selections[key] = indices
+        return indices
+
+    # Chooses one of `actions` at random with `rng`, with probabilities
+    # proportional to their entries in `weights` (one for every action, as
+    # returned by `choice_weights`).
+    def choose(self, rng, actions, weights):
+        cumulative = np.cumsum(weights[self.select(actions)])
+        if not cumulative[-1] > 0:
+            return actions[int(rng.random() * len(actions))]
+        i = np.searchsorted(cumulative, rng.random() * cumulative[-1], "right")
+        return actions[min(int(i), len(actions) - 1)]
+
+    # `targets` and `directions` are N×2 arrays. Returns an N×A array with
+    # the helpfulness of every action for each row.
+    def helpfulness(self, targets, directions):
+        targets = np.asarray(targets, dtype=float)
+        directions = np.asarray(directions, dtype=float)
+        # (R d) · t is the same as d · (Rᵀ t).
+        rotated_targets = np.einsum("aji,nj->nai", self.rotations, targets)
+        new_quality = np.einsum("nai,ni->na", rotated_targets, directions)
+        quality = np.einsum("ni,ni->n", targets, directions)
+        return (new_quality - quality[:, np.newaxis]) / 2
+
+    # Same as `helpfulness`, but returns the weights used to choose actions,
+    # not including the per-action multipliers.
+    def weights(self, targets, directions):
+        helpfulness = self.helpfulness(targets, directions)
+        return self.base_weight + np.maximum(
+            0, helpfulness + self.helpfulness_offset,
+        ) ** self.helpfulness_power
+
+    def choice_weights(self, targets, directions):
+        return self.weights(targets, directions) * self.multipliers
@@ -15,28 +15,104 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with random-directions. If not, see <https://www.gnu.org/licenses/>.
 
-from sensors.config import PORT, MAGNETOMETER, GRAVITY
+from . import clock
+from .capture import Recorder
+from .clock import Clock
+from .decisions import DecisionEngine
+from .history import HeadingBuffer, HeadingSmoother, TurnTracker
+from .orientation import compute_directions
+from .output import OutputQueue, Priority
+from .phrases import PHRASE_LOCALE, PhraseError, PhraseLibrary
+from .roads import Location, RoadError, RoadGraph
+from sensors import discovery, metrics
+from sensors.latest import LatestQueue
+from sensors.config import PORT, MAGNETOMETER, GRAVITY, READ_SIZE
+from sensors.config import DISCOVERY_PORT, MAX_SENSOR_DELAY
+from sensors.parser import FrameParser
+from sensors.protocol import VERSION_BINARY, HEADING, BinaryParser
+from sensors.protocol import LOCATION, NO_BEARING
+from sensors.protocol import DEFAULT_SESSION, TIMESTAMP, accept_hello
 from aioconsole import ainput
-from math3d import Vector, Orientation
+from math3d import Vector
 import asyncio
 import enum
 import json
 import math
+import numpy as np
 import random
 import os
+import re
+import signal
+import socket
 import sys
 import time
+import traceback
+import xml.etree.ElementTree as ElementTree
 
 SCRIPT_DIR = os.path.dirname(__file__)
 CACHE_DIR = os.path.join(SCRIPT_DIR, "..", ".cache")
 TARGET_DIRECTION_PATH = os.path.join(CACHE_DIR, "directions.vec")
+SNAPSHOT_PATH = os.path.join(CACHE_DIR, "state.json")
+CAPTURE_DIR = os.path.join(CACHE_DIR, "captures")
 
 DEBUG = bool(os.environ.get("DEBUG"))
 RESUME = not bool(os.environ.get("NORESUME"))
+RECORD = bool(os.environ.get("RECORD"))
+# If set, random choices are seeded with this and the session ID, so that a
+# run can be reproduced.
+SEED = os.environ.get("DIRECTIONS_SEED")
+# If true, the process replaces itself with a new one after a crash, keeping
+# its sockets, instead of exiting.
+HOT_RESTART = not bool(os.environ.get("NOHOTRESTART"))
+# Environment variable that describes the sockets passed to a new process.
+HANDOFF_VAR = "DIRECTIONS_HANDOFF"
+# Environment variable with the times of recent crashes, passed to a new
+# process.
+CRASHES_VAR = "DIRECTIONS_CRASHES"
 TIME_SPEEDUP = 1
 
 HOST = "0.0.0.0"
-REFERENCE_GRAVITY = Vector(0, 0, 1)
+SOURCE_TIMEOUT = 2
+HISTORY_SIZE = 1024
+STATS_WINDOW = 5
+# Time constant of the heading smoother in seconds; 0 disables smoothing.
+SMOOTHING_TAU = 0.5
+# Samples without timestamps are assumed to have been taken evenly over the
+# time since the previous batch, but at most this long ago.
+MAX_BATCH_SPREAD = 0.5
+# At most RECEIVE_QUEUE_SIZE records wait to be processed (older ones are
+# dropped). Records that are more than MAX_SAMPLE_AGE seconds staler than
+# the freshest seen in the last CLOCK_OFFSET_WINDOW seconds or so are
+# dropped.
+RECEIVE_QUEUE_SIZE = 256
+MAX_SAMPLE_AGE = 1
+CLOCK_OFFSET_WINDOW = 60
+REFERENCE_GRAVITY = (0, 0, 1)
+NO_DATA = (0, 0, 0)
+# If set, actions are limited to the turns that can be made at the next
+# intersection on this road map (see directions/roads.py), at least
+# ROAD_MIN_LOOKAHEAD and at most ROAD_MAX_LOOKAHEAD meters ahead, as long as
+# a sensor client has sent a location in the last MAX_LOCATION_AGE seconds.
+ROAD_MAP = os.environ.get("ROAD_MAP")
+ROAD_MIN_LOOKAHEAD = 30
+ROAD_MAX_LOOKAHEAD = 400
+MAX_LOCATION_AGE = 10
+# The navigator's state is saved at least this often (in seconds) while an
+# action is in progress, and is only restored if it is newer than
+# SNAPSHOT_MAX_AGE.
+SNAPSHOT_INTERVAL = 5
+SNAPSHOT_MAX_AGE = 60
+RESTART_DELAY = 1
+# After MAX_CRASHES crashes within CRASH_WINDOW seconds, the process exits
+# instead of restarting itself. A crash within CRASH_WINDOW seconds of
+# loading a snapshot deletes the snapshot, in case it caused the crash.
+MAX_CRASHES = 3
+CRASH_WINDOW = 60
+# Maximum number of lines waiting to be output.
+OUTPUT_QUEUE_SIZE = 16
+# Metrics are served on localhost in the Prometheus text format; 0 disables
+# them.
+METRICS_PORT = 9101
 _log_file = sys.stderr
 
 
@@ -52,86 +128,584 @@ def log(*args, **kwargs):
         print(*args, **kwargs, file=sys.stderr)
 
 
-class SensorServer:
-    def __init__(self):
-        self.server = None
-        self.reader = None
-        self.writer = None
-        self.done = asyncio.Event()
-        self.ready = asyncio.Event()
-        self._direction = None
+METRICS = metrics.Registry()
+RECORDS_RECEIVED = METRICS.counter(
+    "directions_records_received_total", "Sensor records received",
+)
+RECORDS_UNUSABLE = METRICS.counter(
+    "directions_records_unusable_total",
+    "Sensor records without a usable direction",
+)
+FRAMES_DROPPED = METRICS.counter(
+    "directions_frames_dropped_total",
+    "Sensor frames dropped because they were oversized or invalid, or "
+    "because processing couldn't keep up (backlog)", ["reason"],
+)
+RECORDS_STALE = METRICS.counter(
+    "directions_records_stale_total",
+    "Sensor records dropped because they were too old",
+)
+RECEIVE_QUEUE = METRICS.gauge(
+    "directions_receive_queue_records",
+    "Sensor records waiting to be processed",
+)
+SAMPLE_LAG = METRICS.histogram(
+    "directions_sample_lag_seconds",
+    "How much older the newest record in each batch is than the freshest "
+    "recent data",
+)
+PARSE_TIME = METRICS.histogram(
+    "directions_parse_seconds", "Time spent parsing each chunk of sensor data",
+)
+PROCESS_TIME = METRICS.histogram(
+    "directions_process_seconds",
+    "Time spent processing each batch of sensor records",
+)
+CONNECTIONS = METRICS.gauge(
+    "directions_sensor_connections", "Open sensor connections",
+)
+CONNECTIONS_TOTAL = METRICS.counter(
+    "directions_sensor_connections_total", "Sensor connections accepted",
+)
+LOOP_LAG = METRICS.histogram(
+    "directions_loop_lag_seconds", "Delay in waking up the event loop",
+)
+ROAD_QUERY_TIME = METRICS.histogram(
+    "directions_road_query_seconds",
+    "Time spent finding the next intersection on the road map",
+)
+ACTIONS_EMITTED = METRICS.counter(
+    "directions_actions_total", "Actions emitted", ["action"],
+)
+ACTIONS_ENDED = METRICS.counter(
+    "directions_actions_ended_total",
+    "Actions that ended because the turn was made, the score ran out, or "
+    "they timed out", ["reason"],
+)
+LINES_EMITTED = METRICS.counter(
+    "directions_lines_emitted_total", "Lines of output emitted",
+)
+OUTPUT_DROPPED = METRICS.counter(
+    "directions_output_dropped_total",
+    "Lines dropped before being output because they were superseded or the "
+    "queue was full", ["reason"],
+)
 
-    async def start(self):
-        while True:
-            server = await asyncio.start_server(self.on_connect, HOST, PORT)
-            log("Server started")
-            self.server = server
-            await self.done.wait()
-            log("*** Disconnected ***")
-            self.done.clear()
-            await server.wait_closed()
 
-    async def ensure_ready(self):
-        await self.ready.wait()
+# Estimates the difference between our clock and the client's, plus the
+# shortest delay in getting data from it, as the smallest difference seen in
+# the current and previous windows of `window` seconds. It recovers from
+# the client's clock being set back after at most two windows.
+class ClockOffset:
+    def __init__(self, window):
+        self.window = window
+        self.start = None
+        self.current = math.inf
+        self.previous = math.inf
+
+    def update(self, offset, now):
+        if self.start is None or now - self.start >= self.window:
+            self.previous, self.current = self.current, math.inf
+            self.start = now
+        self.current = min(self.current, offset)
+        return min(self.previous, self.current)
+
+
+class SensorConnection:
+    def __init__(self, server, name, reader=None, writer=None):
+        self.server = server
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.session = None
+        self.version = None
+        self.recorder = None
+        self.last_update = None
+        self._direction = None
+        self.location = None
+        self.history = HeadingBuffer(HISTORY_SIZE)
+        self.clock_offset = ClockOffset(CLOCK_OFFSET_WINDOW)
+        self.smoother = None
+        if SMOOTHING_TAU > 0:
+            self.smoother = HeadingSmoother(SMOOTHING_TAU)
 
     @property
     def direction(self) -> Vector:
         return self._direction
 
-    async def on_connect(self, reader, writer):
-        log("Connected")
-        self.reader = reader
-        self.writer = writer
-        self.server.close()
+    @property
+    def age(self):
+        if self.last_update is None:
+            return math.inf
+        return clock.now() - self.last_update
 
-        while True:
+    # If `handshake` is provided, it is the (version, session ID) already
+    # negotiated with the client, e.g., by a previous process.
+    async def run(self, handshake=None):
+        reader = self.reader
+        if handshake is not None:
+            (version, session_id), chunk = handshake, b""
+        else:
             try:
-                chunk = await reader.readuntil(b"\n}\n")
-            except asyncio.streams.IncompleteReadError:
-                break
-            if self.process_data(json.loads(chunk)):
-                self.ready.set()
-        self.done.set()
+                version, session_id, chunk = await accept_hello(
+                    reader, self.writer,
+                )
+            except (OSError, asyncio.IncompleteReadError) as e:
+                log("Error negotiating protocol: {}".format(e))
+                return
+        self.version = version
+
+        log("Protocol version: {}, session: {}".format(version, session_id))
+        self.session = self.server.session(session_id)
+        self.session.add(self)
+        if RECORD:
+            self.start_recording(session_id)
+        if version == VERSION_BINARY:
+            parser = BinaryParser(
+                [[MAGNETOMETER, GRAVITY], [HEADING], [LOCATION]],
+            )
+        else:
+            parser = FrameParser([MAGNETOMETER, GRAVITY, HEADING, LOCATION])
+
+        # Data is received and parsed separately from processing, so that
+        # everything that arrived while a batch was being processed is
+        # processed together, up to RECEIVE_QUEUE_SIZE records.
+        queue = LatestQueue(RECEIVE_QUEUE_SIZE)
+        receive_task = asyncio.ensure_future(
+            self.receive(parser, chunk, queue),
+        )
+        try:
+            while True:
+                records = await queue.get_all()
+                RECEIVE_QUEUE.dec(len(records))
+                if not records:
+                    break
+                records = self.drop_stale(records)
+                if records:
+                    with PROCESS_TIME.time():
+                        self.process_records(records)
+        finally:
+            receive_task.cancel()
+            RECEIVE_QUEUE.dec(len(queue))
+        receive_task.result()
+
+        if parser.dropped or parser.invalid:
+            log("Warning: Dropped {} oversized and {} invalid frames".format(
+                parser.dropped, parser.invalid,
+            ))
+
+    # Parses `chunk` and then everything read from the connection into
+    # `queue`, and closes it at the end of the connection.
+    async def receive(self, parser, chunk, queue):
+        dropped = invalid = 0
+        try:
+            while True:
+                with PARSE_TIME.time():
+                    records = parser.feed(chunk)
+                if parser.dropped > dropped:
+                    FRAMES_DROPPED.inc(
+                        parser.dropped - dropped, reason="oversized",
+                    )
+                    dropped = parser.dropped
+                if parser.invalid > invalid:
+                    FRAMES_DROPPED.inc(
+                        parser.invalid - invalid, reason="invalid",
+                    )
+                    invalid = parser.invalid
+                overflow = queue.put(records)
+                RECEIVE_QUEUE.inc(len(records) - overflow)
+                if overflow:
+                    FRAMES_DROPPED.inc(overflow, reason="backlog")
+                try:
+                    chunk = await self.reader.read(READ_SIZE)
+                except OSError as e:
+                    log("Read error: {}".format(e))
+                    return
+                if not chunk:
+                    return
+        finally:
+            queue.close()
+
+    # Drops records that are more than MAX_SAMPLE_AGE seconds staler than
+    # the freshest recent data, judging by their timestamps. The client's
+    # clock doesn't need to agree with ours.
+    def drop_stale(self, records):
+        stamps = [data.get(TIMESTAMP) for data in records]
+        if None in stamps:
+            return records
+        now = clock.now()
+        offsets = now - np.array(stamps)
+        lags = offsets - self.clock_offset.update(offsets.min(), now)
+        SAMPLE_LAG.observe(lags[-1])
+        fresh = lags <= MAX_SAMPLE_AGE
+        count = int(np.count_nonzero(fresh))
+        if count == len(records):
+            return records
+        RECORDS_STALE.inc(len(records) - count)
+        log("Warning: Dropped {} stale samples".format(len(records) - count))
+        return [data for data, ok in zip(records, fresh) if ok]
+
+    def start_recording(self, session_id):
+        os.makedirs(CAPTURE_DIR, exist_ok=True)
+        path = capture_path(session_id, self.server.connection_count)
+        try:
+            self.recorder = Recorder(path)
+        except OSError as e:
+            log("Error creating capture: {}".format(e))
+            return
+        log("Recording to {}".format(path))
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
     def process_data(self, data):
-        gravity = self.get_gravity(data)
-        magnetism = self.get_magnetism(data)
-        if not (gravity and magnetism):
-            log("Warning: Did not receive gravity and magnetism data")
-            return False
+        return self.process_records([data]) > 0
 
-        gravity.normalize()
-        orientation = Orientation.new_vec_to_vec(gravity, REFERENCE_GRAVITY)
+    # Processes a batch of records at once and returns the number of records
+    # that contained usable data. The most recent valid record determines
+    # the direction.
+    def process_records(self, records):
+        if self.recorder is not None:
+            self.recorder.write(records, clock.now())
+        if any(LOCATION in data for data in records):
+            self.process_locations(
+                [data for data in records if LOCATION in data],
+            )
+            records = [data for data in records if LOCATION not in data]
+        gravity = []
+        magnetism = []
+        for data in records:
+            if HEADING in data:
+                # A heading is already horizontal; rotating it by the
+                # reference gravity leaves it unchanged.
+                gravity.append(REFERENCE_GRAVITY)
+                magnetism.append(self.get_heading(data))
+                continue
+            gravity.append(self.get_gravity(data))
+            magnetism.append(self.get_magnetism(data))
 
-        magnetism = orientation * magnetism
-        magnetism.z = 0
-        if magnetism.length == 0:
-            log("Warning: Zero-length fixed magnetism")
-            return False
-        magnetism.normalize()
-        self._direction = magnetism
-        return True
+        if not records:
+            return 0
+        directions, valid = compute_directions(gravity, magnetism)
+        count = int(np.count_nonzero(valid))
+        RECORDS_RECEIVED.inc(len(records))
+        if count < len(records):
+            RECORDS_UNUSABLE.inc(len(records) - count)
+            log("Warning: {} of {} samples had no usable direction".format(
+                len(records) - count, len(records),
+            ))
+        if count == 0:
+            return 0
+
+        now = clock.now()
+        times = self.sample_times(records, now)[valid]
+        directions = directions[valid]
+        self.history.extend(times, directions)
+        heading = None
+        if self.smoother is not None:
+            heading = self.smoother.update(times, directions)
+        if heading is None:
+            heading = directions[-1]
+        x, y = heading
+        self._direction = Vector(x, y, 0)
+        self.last_update = now
+        self.session.on_update(self)
+        return count
+
+    def process_locations(self, records):
+        for data in records:
+            try:
+                latitude, longitude, bearing = data[LOCATION]
+            except ValueError:
+                log("Warning: Invalid location data")
+                continue
+            if bearing == NO_BEARING or not math.isfinite(bearing):
+                bearing = None
+            location = Location(latitude, longitude, bearing, clock.now())
+            self.location = location.with_bearing_from(self.location)
+
+    # Local monotonic times of a batch of records. If the client sent
+    # timestamps, they determine the spacing between the samples. Times never
+    # go back past the newest sample already in the history.
+    def sample_times(self, records, now):
+        last_time = self.history.last_time
+        if last_time is None:
+            last_time = now - MAX_BATCH_SPREAD
+        stamps = [data.get(TIMESTAMP) for data in records]
+        if None not in stamps:
+            stamps = np.array(stamps)
+            return np.maximum(now - (stamps[-1] - stamps), last_time)
+        start = max(last_time, now - MAX_BATCH_SPREAD)
+        return np.linspace(start, now, len(records) + 1)[1:]
+
+    def get_heading(self, data):
+        try:
+            x, y, _ = data[HEADING]
+        except ValueError:
+            log("Warning: Invalid heading data")
+            return NO_DATA
+        return x, y, 0
 
     def get_gravity(self, data):
         try:
-            x, y, z = data[GRAVITY]["values"]
-        except KeyError:
+            x, y, z = data[GRAVITY]
+        except (KeyError, ValueError):
             log("Warning: No gravity data")
-            return None
-
-        result = Vector(x, y, z)
-        if result.length == 0:
-            log("Warning: Zero-length gravity vector")
-            return None
-        return result
+            return NO_DATA
+        return x, y, z
 
     def get_magnetism(self, data):
         try:
-            x, y, z = data[MAGNETOMETER]["values"]
-        except KeyError:
+            x, y, z = data[MAGNETOMETER]
+        except (KeyError, ValueError):
             log("Warning: No magnetometer data")
+            return NO_DATA
+        return x, y, z
+
+
+# The sensor connections that belong to one session ID. One of the
+# connections is the source of the session's direction.
+class SensorSession:
+    def __init__(self, id):
+        self.id = id
+        self.connections = []
+        self.source = None
+        self.pinned = False
+        self.ready = asyncio.Event()
+        # Used until a connection becomes the source.
+        self.restored_direction = None
+        # Resolved when the source's direction next changes by more than
+        # WAKE_ANGLE, or a new source is chosen.
+        self.update = None
+        # The source's direction when the current wait started.
+        self.wait_direction = None
+
+    async def ensure_ready(self):
+        await self.ready.wait()
+
+    @property
+    def direction(self) -> Vector:
+        if self.source is None:
+            return self.restored_direction
+        return self.source.direction
+
+    def add(self, connection):
+        self.connections.append(connection)
+
+    def remove(self, connection):
+        self.connections.remove(connection)
+        if connection is self.source:
+            self.pinned = False
+            self.fail_over()
+
+    def on_update(self, connection):
+        source = self.source
+        if source is connection:
+            if self.update is not None and self.heading_changed():
+                self.notify()
+            return
+        if source is None or (
+            not self.pinned and source.age > SOURCE_TIMEOUT
+        ):
+            self.set_source(connection)
+
+    def notify(self):
+        update, self.update = self.update, None
+        if update is not None and not update.done():
+            update.set_result(None)
+
+    def heading_changed(self):
+        last, direction = self.wait_direction, self.direction
+        if last is None or direction is None:
+            return True
+        dot = last.x * direction.x + last.y * direction.y
+        return dot < math.cos(WAKE_ANGLE)
+
+    # Waits until the source's direction has changed by more than WAKE_ANGLE
+    # (or a new source is chosen), for at most `timeout` seconds.
+    async def wait_for_update(self, timeout):
+        if self.update is None:
+            self.update = asyncio.get_event_loop().create_future()
+            self.wait_direction = self.direction
+        try:
+            await asyncio.wait_for(asyncio.shield(self.update), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # If no other connection has data, the disconnected source is kept so
+    # that its last direction is used until a new connection takes over.
+    def fail_over(self):
+        candidates = [
+            c for c in self.connections if c.direction is not None
+        ]
+        if candidates:
+            self.set_source(min(candidates, key=lambda c: c.age))
+
+    def set_source(self, connection, pin=False):
+        self.source = connection
+        self.pinned = pin
+        log("Sensor source for {}: {}".format(self.id, connection.name))
+        if connection.direction is not None:
+            self.ready.set()
+        self.notify()
+
+    @property
+    def history(self):
+        if self.source is None:
             return None
-        return Vector(x, y, z)
+        return self.source.history
+
+    # The most recent location from any of the connections, whether or not
+    # it is the source.
+    @property
+    def location(self):
+        locations = [
+            c.location for c in self.connections if c.location is not None
+        ]
+        if not locations:
+            return None
+        return max(locations, key=lambda location: location.time)
+
+    def print_sources(self):
+        since = clock.now() - STATS_WINDOW
+        for connection in self.connections:
+            heading = connection.history.mean_heading(since)
+            if heading is not None:
+                angle = math.degrees(math.atan2(heading[1], heading[0]))
+                heading = "{:.0f}°".format(angle % 360)
+            variance = connection.history.angular_variance(since)
+            print("{}{} (age: {:.1f} s, heading: {}, variance: {})".format(
+                connection.name,
+                " [source]" if connection is self.source else "",
+                connection.age,
+                heading or "-",
+                "-" if variance is None else "{:.3f}".format(variance),
+            ), file=sys.stderr)
+
+    # Uses `direction` (e.g., from before a restart) until a connection
+    # provides data.
+    def restore_direction(self, direction):
+        self.restored_direction = direction
+        self.ready.set()
+        self.notify()
+
+    # Returns an error message if the source can't be selected.
+    def select_source(self, name):
+        if name == "auto":
+            self.pinned = False
+            if self.source is None or self.source.age > SOURCE_TIMEOUT:
+                self.fail_over()
+            return None
+        for connection in self.connections:
+            if connection.name == name or (
+                connection.name.startswith(name + ":")
+            ):
+                if connection.direction is None:
+                    return "Source has no sensor data yet."
+                self.set_source(connection, pin=True)
+                return None
+        return "Unknown source."
+
+
+# If `multi_session` is false, every connection belongs to DEFAULT_SESSION,
+# regardless of the session ID sent by the client. Otherwise,
+# `on_new_session` (if provided) is called for every new session. `handoff`
+# is the result of `prepare_handoff` in a previous process.
+class SensorServer:
+    connection_class = SensorConnection
+
+    def __init__(
+            self, multi_session=False, on_new_session=None, handoff=None):
+        self.server = None
+        self.multi_session = multi_session
+        self.on_new_session = on_new_session
+        self.handoff = handoff
+        self.sessions = {}
+        self.connection_count = 0
+
+    async def start(self):
+        handoff = self.handoff or {}
+        self.handoff = None
+        if handoff.get("listener") is not None:
+            listener = socket.socket(fileno=handoff["listener"])
+            self.server = await asyncio.start_server(
+                self.on_connect, sock=listener,
+            )
+            log("Server taken over")
+        else:
+            self.server = await asyncio.start_server(
+                self.on_connect, HOST, PORT,
+            )
+            log("Server started")
+        for info in handoff.get("connections", []):
+            asyncio.ensure_future(self.adopt(
+                socket.socket(fileno=info["fd"]),
+                (info["version"], info["session"]),
+            ))
+        async with self.server:
+            await self.server.serve_forever()
+
+    # Makes the listening socket and the sensor connections inheritable by a
+    # new process, and returns a description of them to pass to it.
+    def prepare_handoff(self):
+        handoff = {"listener": None, "connections": []}
+        if self.server is not None and self.server.sockets:
+            fd = self.server.sockets[0].fileno()
+            os.set_inheritable(fd, True)
+            handoff["listener"] = fd
+        for session in self.sessions.values():
+            for connection in session.connections:
+                if connection.writer is None or connection.version is None:
+                    continue
+                sock = connection.writer.get_extra_info("socket")
+                if sock is None:
+                    continue
+                os.set_inheritable(sock.fileno(), True)
+                handoff["connections"].append({
+                    "fd": sock.fileno(),
+                    "version": connection.version,
+                    "session": session.id,
+                })
+        return handoff
+
+    def session(self, id):
+        if not self.multi_session:
+            id = DEFAULT_SESSION
+        session = self.sessions.get(id)
+        if session is None:
+            session = SensorSession(id)
+            self.sessions[id] = session
+            if self.on_new_session:
+                self.on_new_session(session)
+        return session
+
+    # Handles a connection that was accepted by another process. See
+    # `SensorConnection.run` for `handshake`.
+    async def adopt(self, sock, handshake=None):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.on_connect(reader, writer, handshake)
+
+    async def on_connect(self, reader, writer, handshake=None):
+        self.connection_count += 1
+        peer = writer.get_extra_info("peername")
+        name = "{}:{}".format(
+            self.connection_count, peer[0] if peer else "?",
+        )
+        connection = self.connection_class(self, name, reader, writer)
+        log("Connected: {}".format(name))
+        CONNECTIONS_TOTAL.inc()
+        CONNECTIONS.inc()
+        try:
+            await connection.run(handshake)
+        finally:
+            CONNECTIONS.dec()
+            writer.close()
+            connection.stop_recording()
+            if connection.session is not None:
+                connection.session.remove(connection)
+            log("*** Disconnected: {} ***".format(name))
 
 
 class Action(enum.Enum):
@@ -158,78 +732,229 @@ ACTION_ANGLES = {
     Action.forward: 0,
 }
 
-ACTION_MESSAGES = {
-    Action.left: [
-        ("Turn left.", 4),
-        ("You should turn left.", 2),
-        ("Please turn left as soon as possible.", 0.5),
-        ("Left is the way to go.", 0.5),
-        ("Left left left left left!", 0.2),
-        ("Make an l-turn.", 0.1),
-    ],
-    Action.right: [
-        ("Turn right.", 4),
-        ("You should turn right.", 2),
-        ("Please turn right as soon as possible.", 0.5),
-        ("Right is the way to go.", 0.5),
-        ("Right right right right right!", 0.2),
-        ("Make an r-turn.", 0.1),
-    ],
-    Action.back: [
-        ("Turn around.", 1),
-        ("Make a u-turn.", 2),
-        ("Make a v-turn.", 0.2),
-        ("You’re going the wrong way. Turn around.", 0.5),
-        ("Drive in the opposite direction.", 0.5),
-    ],
-    Action.forward: [
-        ("Continue straight.", 1),
-        ("Keep driving.", 1),
-        ("You’re on your way.", 0.35),
-        ("Your destination is somewhere.", 0.1),
-        ("I’m lost, but just keep going.", 0.1),
-        ("Do not turn left.", 0.08),
-        ("Do not turn right.", 0.08),
-        ("Turn around 180 degrees, put the car in reverse, "
-         "and drive backwards. Or just continue straight.", 0.1),
-    ],
-}
-
 ACTION_BASE_WEIGHT = 0
 ACTION_HELPFULNESS_OFFSET = 1
 ACTION_HELPFULNESS_POWER = 2
 ACTION_TIMEOUT_RANGE = (60, 150)
 ACTION_INITIAL_DELAY_RANGE = (5, 10)
+# After the initial delay, an action's score changes by (quality +
+# POLL_QUALITY_OFFSET) / POLL_QUALITY_DIVISOR for every POLL_INTERVAL
+# seconds that each heading was the latest one, up to POLL_MAX_SCORE; the
+# action ends when its score runs out. A heading counts for at most
+# MAX_SAMPLE_SPAN seconds, the longest delay the sensor client can be set to.
+# The score is only updated when the heading changes by more than WAKE_ANGLE
+# radians, or when it is expected to have run out, but at most every
+# MIN_EVALUATION_WAIT seconds.
 POLL_INTERVAL = 1
 POLL_QUALITY_OFFSET = -0.5
 POLL_QUALITY_DIVISOR = 22
 POLL_MAX_SCORE = 1
+MAX_SAMPLE_SPAN = MAX_SENSOR_DELAY / 1000
+WAKE_ANGLE = math.pi / 36
+MIN_EVALUATION_WAIT = 0.1
+# An action also ends once its turn has been made: the heading has changed
+# by TURN_COMPLETE_FRACTION of the action's angle since the action was
+# given, and has changed by less than TURN_SETTLED_RATE radians per second
+# over the last TURN_RATE_WINDOW seconds.
+TURN_COMPLETE_FRACTION = 0.75
+TURN_SETTLED_RATE = 0.1
+TURN_RATE_WINDOW = 2
 INITIAL_DELAY_RANGE = (10, 30)
 HIGHWAY_DURATION_RANGE = (200, 600)
 
 
-async def sleep(duration):
-    await asyncio.sleep(duration / TIME_SPEEDUP)
+PHRASES = PhraseLibrary(
+    [action.name for action in ACTIONS],
+    [action.name for action in IMMEDIATE_ACTIONS],
+    log=log,
+)
+
+
+# Every line the navigator can emit with the phrases for `locale`.
+def fixed_messages(locale=PHRASE_LOCALE):
+    return PHRASES.get(locale).messages()
+
+
+# Without DIRECTIONS_SEED, navigators are seeded from the global generator,
+# so seeding it (as the simulator does) makes every navigator reproducible.
+def make_rng(session_id):
+    if SEED is None:
+        return random.Random(random.random())
+    return random.Random("{}:{}".format(SEED, session_id))
 
 
-def monotonic():
-    return time.monotonic() / TIME_SPEEDUP
+def make_decision_engine():
+    return DecisionEngine(
+        ACTIONS, ACTION_ANGLES, ACTION_WEIGHT_MULTIPLIERS,
+        base_weight=ACTION_BASE_WEIGHT,
+        helpfulness_offset=ACTION_HELPFULNESS_OFFSET,
+        helpfulness_power=ACTION_HELPFULNESS_POWER,
+    )
 
 
+DECISION_ENGINE = make_decision_engine()
+_road_graph = None
+
+
+# Loads ROAD_MAP once per process, or returns None if it isn't set or can't
+# be loaded.
+def road_graph():
+    global _road_graph
+    if _road_graph is None and ROAD_MAP:
+        try:
+            _road_graph = RoadGraph.load(ROAD_MAP, CACHE_DIR)
+        except (OSError, ElementTree.ParseError, RoadError) as e:
+            log("Error loading road map: {}".format(e))
+            return None
+        log("Loaded road map: {} nodes".format(len(_road_graph)))
+    return _road_graph
+
+
+# The action closest to each of `turns` (see roads.Intersection). Turning
+# around is possible anywhere.
+def turn_actions(turns):
+    actions = {Action.back}
+    for turn in turns:
+        actions.add(min(ACTIONS, key=lambda action: abs(
+            (turn - ACTION_ANGLES[action] + math.pi) % (2 * math.pi)
+            - math.pi
+        )))
+    return actions
+
+
+def session_file_name(session_id):
+    return re.sub(r"[^\w.-]", "_", session_id)
+
+
+def target_direction_path(session_id):
+    if session_id == DEFAULT_SESSION:
+        return TARGET_DIRECTION_PATH
+    name = session_file_name(session_id)
+    return os.path.join(CACHE_DIR, "directions-{}.vec".format(name))
+
+
+def snapshot_path(session_id):
+    if session_id == DEFAULT_SESSION:
+        return SNAPSHOT_PATH
+    name = session_file_name(session_id)
+    return os.path.join(CACHE_DIR, "state-{}.json".format(name))
+
+
+def capture_path(session_id, connection_number):
+    return os.path.join(CAPTURE_DIR, "{}-{}-{}.cap".format(
+        session_file_name(session_id),
+        time.strftime("%Y%m%d-%H%M%S"),
+        connection_number,
+    ))
+
+
+# Adds each of `deltas` to `score` in turn, capping the score at `cap` after
+# every addition.
+def add_capped(score, deltas, cap):
+    if len(deltas) == 0:
+        return score
+    sums = np.cumsum(deltas)
+    return float(sums[-1] + min(score, np.min(cap - sums)))
+
+
+# Progress of the action being followed. Times are according to the
+# navigator's clock; `end_time` is None until polling starts. `turn` is the
+# angle of the action, and `turned` is how far the vehicle has turned since
+# it was given. `sample_time` is the time (according to the sensor data) of
+# the newest sample that has been evaluated, and `heading` is that sample's
+# heading. `scored_time` is the time up to which the score has been updated.
+class ActionProgress:
+    def __init__(self, poll_time, end_time=None, score=1, turn=0, turned=0):
+        self.poll_time = poll_time
+        self.end_time = end_time
+        self.score = score
+        self.turn = turn
+        self.tracker = TurnTracker(turned)
+        self.sample_time = None
+        self.heading = None
+        self.scored_time = None
+
+    # Times in snapshots are relative to when the snapshot was taken.
+    def to_json(self, now):
+        return {
+            "poll_in": self.poll_time - now,
+            "end_in": None if self.end_time is None else self.end_time - now,
+            "score": self.score,
+            "turn": self.turn,
+            "turned": self.tracker.turned,
+        }
+
+    @classmethod
+    def from_json(cls, data, now):
+        end_in = data["end_in"]
+        return cls(
+            now + float(data["poll_in"]),
+            None if end_in is None else now + float(end_in),
+            float(data["score"]),
+            float(data.get("turn", 0)),
+            float(data.get("turned", 0)),
+        )
+
+    # Whether the vehicle has turned far enough in the action's direction.
+    # Turning around counts in either direction.
+    @property
+    def turn_made(self):
+        if self.turn == 0:
+            return False
+        turned = self.tracker.turned
+        if abs(self.turn) >= math.pi:
+            turned = abs(turned)
+        elif self.turn < 0:
+            turned = -turned
+        return turned >= TURN_COMPLETE_FRACTION * abs(self.turn)
+
+
+# `clock` defaults to one with a speedup of TIME_SPEEDUP. If `persist` is
+# false, neither the target direction nor a snapshot of the navigator's
+# state is loaded or saved. If `echo` is false, emitted messages aren't
+# copied to stderr. `on_action`, if set, is called with every action that is
+# emitted. All random choices are made with `rng` (by default, one seeded
+# from DIRECTIONS_SEED if it is set). Lines come from the phrase pack for
+# `locale`.
 class Navigator:
-    def __init__(self, sensors: SensorServer):
+    def __init__(
+            self, sensors: SensorSession, output=None, clock=None,
+            persist=True, echo=True, rng=None, locale=PHRASE_LOCALE):
+        self.rng = rng or make_rng(sensors.id)
+        self.locale = locale
+        # The pack whose lines were last given to the output to prepare.
+        self.pack = PHRASES.get(locale)
         self.sensors = sensors
+        self.output = output or sys.stdout
+        self.clock = clock or Clock(TIME_SPEEDUP)
+        self.persist = persist
+        self.echo = echo
+        self.on_action = None
+        self.prefix = ""
+        if sensors.id != DEFAULT_SESSION:
+            self.prefix = "[{}] ".format(sensors.id)
+        self.line_start = True
+        self.output_queue = OutputQueue(OUTPUT_QUEUE_SIZE)
+        self.commands = asyncio.Queue()
+        self.target_path = target_direction_path(sensors.id)
+        self.snapshot_path = snapshot_path(sensors.id)
         self.target_direction = None
         self.load_target_direction()
         self.next_action_task = None
+        self.action_progress = None
+        self.restored_action = None
+        self.last_snapshot = -math.inf
+        # When a snapshot was loaded, in real time.
+        self.snapshot_loaded = None
         self.highway = False
         self.resume_directions = asyncio.Event()
         self.resume_directions.set()
+        self.roads = road_graph()
 
     def load_target_direction(self):
-        if RESUME:
+        if RESUME and self.persist:
             try:
-                with open(TARGET_DIRECTION_PATH, encoding="utf8") as f:
+                with open(self.target_path, encoding="utf8") as f:
                     direction = Vector(*map(float, f.read().split(",")))
                     self.target_direction = direction
                     return
@@ -238,25 +963,136 @@ class Navigator:
         self.change_target_direction()
 
     def change_target_direction(self):
-        angle = random.uniform(0, math.pi * 2)
+        angle = self.rng.uniform(0, math.pi * 2)
         self.target_direction = Vector(math.cos(angle), math.sin(angle))
-        log("Target direction: {}".format(self.target_direction))
-        with open(TARGET_DIRECTION_PATH, "w", encoding="utf8") as f:
+        log("{}Target direction: {}".format(
+            self.prefix, self.target_direction,
+        ))
+        if not self.persist:
+            return
+        with open(self.target_path, "w", encoding="utf8") as f:
             print(",".join(map(str, self.target_direction)), file=f)
 
     @property
     def direction(self):
         return self.sensors.direction
 
+    @property
+    def phrases(self):
+        return self.load_phrases()
+
+    # If the pack has been reloaded or the locale has changed, outputs that
+    # support it (see SpeechOutput) are given the new lines to prepare.
+    def load_phrases(self):
+        pack = PHRASES.get(self.locale)
+        if pack is not self.pack:
+            self.pack = pack
+            prepare = getattr(self.output, "prepare", None)
+            if prepare is not None:
+                prepare(pack.messages())
+        return pack
+
+    # Returns whether the phrases were changed.
+    def set_locale(self, locale):
+        try:
+            PHRASES.get(locale)
+        except PhraseError as e:
+            log("{}{}".format(self.prefix, e))
+            return False
+        self.locale = locale
+        self.load_phrases()
+        return True
+
+    # Saves the target direction, highway mode, the action in progress and
+    # the last heading, so that a new process can carry on.
+    def save_snapshot(self):
+        now = self.clock.monotonic()
+        self.last_snapshot = now
+        if not self.persist:
+            return
+        direction = self.direction
+        progress = self.action_progress
+        state = {
+            "time": time.time(),
+            "target": [self.target_direction.x, self.target_direction.y],
+            "highway": self.highway,
+            "action": None if progress is None else progress.to_json(now),
+            "heading": None if direction is None else [
+                direction.x, direction.y,
+            ],
+        }
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.snapshot_path)
+
+    # Returns whether a recent snapshot was restored.
+    def restore_snapshot(self):
+        if not (RESUME and self.persist):
+            return False
+        try:
+            with open(self.snapshot_path, encoding="utf8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.snapshot_loaded = time.monotonic()
+        try:
+            age = time.time() - state["time"]
+            if not 0 <= age <= SNAPSHOT_MAX_AGE:
+                return False
+            target = Vector(*state["target"])
+            heading = state["heading"]
+            action = state["action"]
+            if action is not None:
+                now = self.clock.monotonic() - age * self.clock.speedup
+                action = ActionProgress.from_json(action, now)
+            highway = bool(state["highway"])
+        except (KeyError, TypeError, ValueError) as e:
+            log("{}Invalid snapshot: {!r}".format(self.prefix, e))
+            return False
+
+        self.target_direction = target
+        self.highway = highway
+        self.restored_action = action
+        if heading is not None:
+            self.sensors.restore_direction(Vector(*heading))
+        log("{}Restored snapshot from {:.1f} s ago".format(self.prefix, age))
+        return True
+
+    # Deletes the snapshot if it was loaded less than CRASH_WINDOW seconds
+    # ago. Returns whether it was deleted.
+    def discard_snapshot(self):
+        loaded = self.snapshot_loaded
+        if loaded is None or time.monotonic() - loaded > CRASH_WINDOW:
+            return False
+        try:
+            os.remove(self.snapshot_path)
+        except FileNotFoundError:
+            pass
+        log("{}Discarded snapshot".format(self.prefix))
+        return True
+
     async def start(self):
         log("Directions started")
+        restored = self.restore_snapshot()
+        if self.highway:
+            self.resume_directions.clear()
         await self.sensors.ensure_ready()
         log("Sensors ready")
-        await asyncio.gather(self.navigation_loop(), self.interactive_loop())
+        await asyncio.gather(
+            self.navigation_loop(resumed=restored),
+            self.interactive_loop(),
+            self.output_loop(),
+        )
+
+    async def read_command(self):
+        return await self.commands.get()
 
     async def interactive_loop(self):
+        if self.highway:
+            await self.schedule_highway(announce=False)
         while True:
-            cmd = await ainput()
+            cmd = await self.read_command()
             if not cmd:
                 self.emit_immediate_action()
                 continue
@@ -266,39 +1102,190 @@ class Navigator:
             if cmd == "highway":
                 await self.schedule_highway()
                 continue
+            if cmd == "sources":
+                self.sensors.print_sources()
+                continue
+            if cmd.startswith("source "):
+                error = self.sensors.select_source(cmd.split(None, 1)[1])
+                if error is not None:
+                    print(error, file=sys.stderr)
+                continue
+            if cmd.startswith("phrases "):
+                if not self.set_locale(cmd.split(None, 1)[1]):
+                    print("Unknown phrases. Available: {}".format(
+                        ", ".join(PHRASES.locales()),
+                    ), file=sys.stderr)
+                continue
             print("Unknown command.", file=sys.stderr)
 
-    async def navigation_loop(self):
-        self.emit_start()
-        await sleep(random.uniform(*INITIAL_DELAY_RANGE))
+    # If `resumed` is true, the navigator continues from a snapshot instead
+    # of starting from the beginning.
+    async def navigation_loop(self, resumed=False):
+        if not resumed:
+            self.emit_start()
+            await self.clock.sleep(self.rng.uniform(*INITIAL_DELAY_RANGE))
+        progress, self.restored_action = self.restored_action, None
         while True:
             await self.resume_directions.wait()
-            self.next_action_task = asyncio.create_task(self.next_action())
+            self.next_action_task = asyncio.create_task(
+                self.next_action(progress),
+            )
+            progress = None
+            # Waiting with asyncio.wait keeps a cancelled action apart from
+            # this loop itself being cancelled.
             try:
-                await self.next_action_task
-            except asyncio.CancelledError:
+                await asyncio.wait([self.next_action_task])
+            finally:
+                self.cancel_next_action()
+            if self.next_action_task.cancelled():
                 log("Action cancelled.")
+                continue
+            self.next_action_task.result()
 
+    # With a road map, only actions that can be taken at the next
+    # intersection are chosen, unless none of `actions` can be.
     def choose_next_action(self, actions):
-        return random.choices(actions, [
-            self.action_weight(action) * ACTION_WEIGHT_MULTIPLIERS[action]
-            for action in actions
-        ])[0]
-
-    async def next_action(self):
-        self.emit_action(self.choose_next_action(ACTIONS))
-        await sleep(random.uniform(*ACTION_INITIAL_DELAY_RANGE))
-        timeout = random.uniform(*ACTION_TIMEOUT_RANGE)
-        end_time = monotonic() + timeout
-        score = 1
-
-        while score > 0 and monotonic() < end_time:
-            await sleep(POLL_INTERVAL)
-            score_delta = (
-                (self.quality() + POLL_QUALITY_OFFSET) / POLL_QUALITY_DIVISOR
+        available = self.road_actions()
+        if available is not None:
+            actions = [a for a in actions if a in available] or actions
+        weights = self.decision_inputs(DECISION_ENGINE.choice_weights)[0]
+        return DECISION_ENGINE.choose(self.rng, actions, weights)
+
+    # Returns the set of actions that can be taken at the next intersection,
+    # or None if that isn't known.
+    def road_actions(self):
+        if self.roads is None:
+            return None
+        location = self.sensors.location
+        if location is None or (
+            clock.now() - location.time > MAX_LOCATION_AGE
+        ):
+            return None
+        with ROAD_QUERY_TIME.time():
+            intersection = self.roads.next_intersection(
+                location, ROAD_MIN_LOOKAHEAD, ROAD_MAX_LOOKAHEAD,
             )
-            score += score_delta
-            score = min(score, POLL_MAX_SCORE)
+        if intersection is None:
+            return None
+        return turn_actions(intersection.turns)
+
+    # If `progress` is provided, that action is continued instead of a new
+    # one being chosen.
+    async def next_action(self, progress=None):
+        if progress is None:
+            action = self.choose_next_action(ACTIONS)
+            self.emit_action(action)
+            delay = self.rng.uniform(*ACTION_INITIAL_DELAY_RANGE)
+            progress = ActionProgress(
+                self.clock.monotonic() + delay, turn=ACTION_ANGLES[action],
+            )
+        self.action_progress = progress
+        try:
+            await self.follow_action(progress)
+        finally:
+            self.action_progress = None
+
+    # The action only runs when the heading changes, so the next action can
+    # be given as soon as the turn has been made, or when the action could
+    # end (see `next_deadline`).
+    async def follow_action(self, progress):
+        self.save_snapshot()
+        # Only data from after the action was given (or resumed) counts.
+        progress.sample_time = progress.scored_time = clock.now()
+        while True:
+            now = self.clock.monotonic()
+            if progress.end_time is None and now >= progress.poll_time:
+                timeout = self.rng.uniform(*ACTION_TIMEOUT_RANGE)
+                progress.end_time = now + timeout
+            if progress.end_time is not None:
+                if progress.score <= 0:
+                    ACTIONS_ENDED.inc(reason="score")
+                    return
+                if now >= progress.end_time:
+                    ACTIONS_ENDED.inc(reason="timeout")
+                    return
+            if progress.turn_made and self.turn_settled():
+                ACTIONS_ENDED.inc(reason="turned")
+                return
+            if now - self.last_snapshot >= SNAPSHOT_INTERVAL:
+                self.save_snapshot()
+            timeout = self.next_deadline(progress) - self.clock.monotonic()
+            await self.sensors.wait_for_update(timeout / self.clock.speedup)
+            self.evaluate(progress)
+
+    # The time at which the action should be evaluated even if the heading
+    # doesn't change: when polling starts, when the score would run out at
+    # the current heading, when the action times out, or, once the turn has
+    # been made, when it could have settled.
+    def next_deadline(self, progress):
+        now = self.clock.monotonic()
+        if progress.end_time is None:
+            deadline = progress.poll_time
+        else:
+            deadline = min(progress.end_time, self.score_deadline(progress))
+        if progress.turn_made:
+            deadline = min(deadline, now + TURN_RATE_WINDOW)
+        return max(deadline, now + MIN_EVALUATION_WAIT)
+
+    def score_deadline(self, progress):
+        heading = progress.heading
+        if heading is None:
+            return math.inf
+        if clock.now() >= progress.sample_time + MAX_SAMPLE_SPAN:
+            return math.inf
+        quality = heading @ self.target_direction[:2]
+        rate = (quality + POLL_QUALITY_OFFSET) / POLL_QUALITY_DIVISOR
+        if rate >= 0:
+            return math.inf
+        return self.clock.monotonic() + progress.score / -rate * POLL_INTERVAL
+
+    # Follows the turn through the samples received since the last
+    # evaluation, and, once polling has started, scores each heading by how
+    # long it was the latest one: until the next sample, or until now for
+    # the newest one.
+    def evaluate(self, progress):
+        history = self.sensors.history
+        if history is None:
+            return
+        now = clock.now()
+        times, headings = history.window(progress.sample_time)
+        if len(times) > 0:
+            progress.tracker.update(headings)
+        if progress.heading is not None:
+            times = np.concatenate([[progress.sample_time], times])
+            headings = np.concatenate([[progress.heading], headings])
+        if len(times) == 0:
+            progress.scored_time = now
+            return
+        starts = np.maximum(times, progress.scored_time)
+        ends = np.minimum(
+            np.concatenate([times[1:], [now]]), times + MAX_SAMPLE_SPAN,
+        )
+        progress.sample_time = times[-1]
+        progress.heading = headings[-1]
+        progress.scored_time = now
+        if progress.end_time is None:
+            return
+
+        speedup = self.clock.speedup
+        starts = np.maximum(starts, progress.poll_time / speedup)
+        spans = np.maximum(ends - starts, 0)
+        quality = headings @ self.target_direction[:2]
+        deltas = (
+            (quality + POLL_QUALITY_OFFSET) / POLL_QUALITY_DIVISOR
+            * spans * speedup / POLL_INTERVAL
+        )
+        progress.score = add_capped(progress.score, deltas, POLL_MAX_SCORE)
+
+    # Whether the heading has stopped changing, according to the last
+    # TURN_RATE_WINDOW seconds of data.
+    def turn_settled(self):
+        history = self.sensors.history
+        if history is None:
+            return False
+        speedup = self.clock.speedup
+        rate = history.turn_rate(clock.now() - TURN_RATE_WINDOW / speedup)
+        return rate is not None and abs(rate) / speedup <= TURN_SETTLED_RATE
 
     def cancel_next_action(self):
         if not self.next_action_task:
@@ -307,18 +1294,22 @@ class Navigator:
             return
         self.next_action_task.cancel()
 
-    async def schedule_highway(self):
+    async def schedule_highway(self, announce=True):
         self.resume_directions.clear()
         self.cancel_next_action()
+        self.highway = True
+        self.save_snapshot()
         try:
-            await self.do_highway()
+            await self.do_highway(announce)
         finally:
+            self.highway = False
+            self.save_snapshot()
             self.resume_directions.set()
 
-    async def do_highway(self):
-        self.emit("Highway mode started. Type “exit” when you exit, ", end="")
-        self.emit("or “new” if you merge onto a new highway.")
-        self.emit("Press enter for an immediate direction.")
+    async def do_highway(self, announce=True):
+        if announce:
+            for message in self.phrases.highway_start:
+                self.emit(message)
         exit = False
 
         async def interactive_loop():
@@ -329,7 +1320,7 @@ class Navigator:
                     sleep_task.cancel()
 
             while True:
-                cmd = await ainput()
+                cmd = await self.read_command()
                 if not cmd:
                     self.emit_immediate_action()
                     continue
@@ -343,65 +1334,215 @@ class Navigator:
                 print("Unknown command.", file=sys.stderr)
 
         while not exit:
-            duration = random.uniform(*HIGHWAY_DURATION_RANGE)
-            sleep_task = asyncio.create_task(asyncio.sleep(duration))
+            duration = self.rng.uniform(*HIGHWAY_DURATION_RANGE)
+            sleep_task = asyncio.create_task(self.clock.sleep(duration))
             interactive_loop_task = asyncio.create_task(interactive_loop())
             try:
                 await sleep_task
             except asyncio.CancelledError:
                 continue
-            self.emit("Exit the highway. Type exit when you exit.")
+            self.emit(self.phrases.highway_exit)
             exit = True
 
         await interactive_loop_task
-        self.emit("Highway mode stopped.")
+        self.emit(self.phrases.highway_stop)
         self.change_target_direction()
 
     def emit_immediate_action(self):
         action = self.choose_next_action(IMMEDIATE_ACTIONS)
-        message = {
-            Action.left: "Go left.",
-            Action.right: "Go right.",
-        }[action]
-        self.emit(message)
+        self.emit(
+            self.phrases.immediate[action.name].choose(self.rng),
+            priority=Priority.urgent,
+        )
+        ACTIONS_EMITTED.inc(action=action.name)
+        if self.on_action:
+            self.on_action(action)
 
     def quality(self, direction=None):
         return self.target_direction * (direction or self.direction)
 
+    def decision_inputs(self, function):
+        target = self.target_direction
+        direction = self.direction
+        return function([(target.x, target.y)], [(direction.x, direction.y)])
+
     def helpfulness(self, action):
-        angle = ACTION_ANGLES[action]
-        new_direction = Orientation.new_rot_z(angle) * self.direction
-        return (self.quality(new_direction) - self.quality(self.direction)) / 2
+        helpfulness = self.decision_inputs(DECISION_ENGINE.helpfulness)[0]
+        return helpfulness[DECISION_ENGINE.indices[action]]
 
     def action_weight(self, action):
-        return (
-            ACTION_BASE_WEIGHT +
-            max(0, self.helpfulness(action) + ACTION_HELPFULNESS_OFFSET) **
-            ACTION_HELPFULNESS_POWER
-        )
+        weights = self.decision_inputs(DECISION_ENGINE.weights)[0]
+        return weights[DECISION_ENGINE.indices[action]]
 
     def emit_start(self):
-        self.emit("Start driving. Press enter at any time ", end="")
-        self.emit("if you need an immediate direction.")
-        self.emit("Type “highway” to start highway mode.")
+        for message in self.phrases.start:
+            self.emit(message)
 
     def emit_action(self, action):
-        messages = ACTION_MESSAGES[action]
-        strings = [m[0] for m in messages]
-        weights = [m[1] for m in messages]
-        self.emit(random.choices(strings, weights)[0])
+        self.emit(
+            self.phrases.actions[action.name].choose(self.rng),
+            priority=Priority.direction,
+        )
+        ACTIONS_EMITTED.inc(action=action.name)
+        if self.on_action:
+            self.on_action(action)
+
+    # Directions (with a priority of `Priority.direction` or higher)
+    # supersede any directions that haven't been output yet.
+    def emit(self, message, end="\n", priority=Priority.info):
+        if self.echo:
+            prefix = self.prefix if self.line_start else ""
+            print(prefix + message, file=sys.stderr, end=end)
+        superseded, dropped = self.output_queue.put(
+            message + end, priority,
+            supersede=priority <= Priority.direction,
+        )
+        for text in superseded:
+            log("{}Superseded: {}".format(self.prefix, text.strip()))
+        for text in dropped:
+            log("{}Output queue full; dropped: {}".format(
+                self.prefix, text.strip(),
+            ))
+        OUTPUT_DROPPED.inc(len(superseded), reason="superseded")
+        OUTPUT_DROPPED.inc(len(dropped), reason="full")
+        self.line_start = end.endswith("\n")
+        if self.line_start:
+            LINES_EMITTED.inc()
+
+    # Outputs with an async `speak` method are given each line directly.
+    # Other outputs are treated as files and written to from another thread,
+    # so that a slow reader (such as a speech process that has fallen
+    # behind) can't block the event loop.
+    async def output_loop(self):
+        loop = asyncio.get_event_loop()
+        speak = getattr(self.output, "speak", None)
+        while True:
+            text = await self.output_queue.get()
+            if speak is not None:
+                await speak(text)
+            else:
+                await loop.run_in_executor(None, self.write_output, text)
+
+    def write_output(self, text):
+        self.output.write(text)
+        self.output.flush()
+
+
+async def read_commands(handler):
+    while True:
+        handler(await ainput())
+
+
+# Serves METRICS on `port` and measures event loop lag until cancelled.
+async def serve_metrics(port=METRICS_PORT):
+    await metrics.serve_with_lag(METRICS, LOOP_LAG, port, log)
 
-    def emit(self, message, end="\n"):
-        print(message, file=sys.stderr, end=end)
-        print(message, end=end)
 
+# Answers sensor clients looking for the navigator on the local network.
+async def serve_discovery():
+    if not DISCOVERY_PORT:
+        return
+    try:
+        await discovery.serve(PORT, DISCOVERY_PORT, HOST)
+    except OSError as e:
+        log("Error starting discovery: {}".format(e))
 
-def run():
+
+def take_handoff():
+    data = os.environ.pop(HANDOFF_VAR, None)
+    if not data:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        log("Invalid handoff: {}".format(data))
+        return None
+
+
+# Replaces this process with a new one, which takes over the listening
+# socket and the sensor connections and continues from a snapshot of the
+# navigator's state (unless `save` is false).
+def hot_restart(server, navigator, save=True):
+    try:
+        if save:
+            navigator.save_snapshot()
+    except Exception:
+        log(traceback.format_exc())
+    handoff = server.prepare_handoff()
+    log("Restarting with {} sensor connection(s)...".format(
+        len(handoff["connections"]),
+    ))
+    os.environ[HANDOFF_VAR] = json.dumps(handoff)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable, "-u", "-m", __package__])
+
+
+# The times of the crashes in the last CRASH_WINDOW seconds, including
+# those of previous processes.
+def recent_crashes():
+    try:
+        times = json.loads(os.environ.get(CRASHES_VAR, "[]"))
+    except ValueError:
+        return []
+    now = time.time()
+    return [
+        t for t in times
+        if isinstance(t, (int, float)) and 0 <= now - t <= CRASH_WINDOW
+    ]
+
+
+# `tasks` are run along with the navigator. The process restarts itself (see
+# `hot_restart`) on SIGHUP, on the "restart" command, and, if HOT_RESTART is
+# true, when it crashes, unless it has crashed MAX_CRASHES times within
+# CRASH_WINDOW seconds.
+def run(output=None, tasks=()):
     log("Directions starting...")
     loop = asyncio.get_event_loop()
-    server = SensorServer()
-    navigator = Navigator(server)
-    loop.run_until_complete(asyncio.gather(
+    server = SensorServer(handoff=take_handoff())
+    navigator = Navigator(server.session(DEFAULT_SESSION), output=output)
+    restart = loop.create_future()
+
+    def request_restart():
+        if not restart.done():
+            restart.set_result(None)
+
+    def handle_command(cmd):
+        if cmd == "restart":
+            request_restart()
+            return
+        navigator.commands.put_nowait(cmd)
+
+    loop.add_signal_handler(signal.SIGHUP, request_restart)
+    main = asyncio.gather(
         server.start(),
         navigator.start(),
-    ))
+        read_commands(handle_command),
+        serve_metrics(),
+        serve_discovery(),
+        *tasks,
+    )
+    try:
+        loop.run_until_complete(asyncio.wait(
+            [main, restart], return_when=asyncio.FIRST_COMPLETED,
+        ))
+        if main.done():
+            main.result()
+    except EOFError:
+        raise
+    except Exception:
+        if not HOT_RESTART:
+            raise
+        crashes = recent_crashes() + [time.time()]
+        if len(crashes) >= MAX_CRASHES:
+            log("Crashed {} times in {} s. Exiting.".format(
+                len(crashes), CRASH_WINDOW,
+            ))
+            raise
+        log(traceback.format_exc())
+        os.environ[CRASHES_VAR] = json.dumps(crashes)
+        save = not navigator.discard_snapshot()
+        log("Crashed. Restarting...")
+        time.sleep(RESTART_DELAY)
+        hot_restart(server, navigator, save=save)
+    hot_restart(server, navigator)
@@ -0,0 +1,158 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+# Fixed-size ring buffer of timestamped unit headings (x, y).
+class HeadingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.headings = np.zeros((capacity, 2))
+        self.end = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def last_time(self):
+        if self.count == 0:
+            return None
+        return self.times[self.end - 1]
+
+    def append(self, time, heading):
+        self.times[self.end] = time
+        self.headings[self.end] = heading
+        self.end = (self.end + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def extend(self, times, headings):
+        times = times[-self.capacity:]
+        headings = headings[-self.capacity:]
+        n = len(times)
+        indices = (self.end + np.arange(n)) % self.capacity
+        self.times[indices] = times
+        self.headings[indices] = headings
+        self.end = (self.end + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    # Returns the times and headings of the samples newer than `since` (or
+    # all samples), oldest first.
+    def window(self, since=None):
+        indices = (self.end - self.count + np.arange(self.count))
+        indices %= self.capacity
+        times = self.times[indices]
+        headings = self.headings[indices]
+        if since is not None:
+            start = np.searchsorted(times, since, side="right")
+            times = times[start:]
+            headings = headings[start:]
+        return times, headings
+
+    # Unit vector of the circular mean heading, or None if there are no
+    # samples or they cancel out.
+    def mean_heading(self, since=None):
+        _, headings = self.window(since)
+        if len(headings) == 0:
+            return None
+        mean = headings.mean(axis=0)
+        length = np.hypot(*mean)
+        if length == 0:
+            return None
+        return mean / length
+
+    # Circular variance: 0 if every heading is the same, 1 if they are
+    # spread evenly around the circle.
+    def angular_variance(self, since=None):
+        _, headings = self.window(since)
+        if len(headings) == 0:
+            return None
+        return 1 - np.hypot(*headings.mean(axis=0))
+
+    # Rate of change of the heading's angle in radians per second, fitted by
+    # least squares, or None if the samples don't span any time.
+    def turn_rate(self, since=None):
+        times, headings = self.window(since)
+        if len(times) < 2 or times[-1] == times[0]:
+            return None
+        angles = np.unwrap(heading_angles(headings))
+        return np.polyfit(times - times[0], angles, 1)[0]
+
+
+def heading_angles(headings):
+    return np.arctan2(headings[:, 1], headings[:, 0])
+
+
+# Total change in the angle of a stream of unit headings, counting full
+# circles. Consecutive samples are assumed to be less than half a circle
+# apart.
+class TurnTracker:
+    def __init__(self, turned=0):
+        self.turned = turned
+        self.angle = None
+
+    def update(self, headings):
+        if len(headings) == 0:
+            return self.turned
+        angles = heading_angles(headings)
+        if self.angle is None:
+            self.angle = angles[0]
+        steps = np.diff(np.concatenate([[self.angle], angles]))
+        self.turned += float(np.sum((steps + np.pi) % (2 * np.pi) - np.pi))
+        self.angle = angles[-1]
+        return self.turned
+
+
+# Exponential smoothing of unit headings with time constant `tau` (in
+# seconds). Headings are averaged as vectors and renormalized, so smoothing
+# works across the ±π boundary.
+class HeadingSmoother:
+    def __init__(self, tau):
+        self.tau = tau
+        self.state = None
+        self.time = None
+
+    # Folds in a batch of samples and returns the smoothed heading after the
+    # last one, or None if it is undefined.
+    def update(self, times, headings):
+        if len(times) == 0:
+            return self.heading
+        if self.state is None:
+            self.state = headings[0]
+            self.time = times[0]
+
+        end = times[-1]
+        # Weight of each sample in the final state: its own smoothing factor,
+        # decayed by the time elapsed until the last sample.
+        previous = np.concatenate([[self.time], times[:-1]])
+        gains = -np.expm1(-np.maximum(times - previous, 0) / self.tau)
+        weights = gains * np.exp(-(end - times) / self.tau)
+        decay = np.exp(-max(end - self.time, 0) / self.tau)
+        self.state = decay * self.state + weights @ headings
+        self.time = end
+        return self.heading
+
+    @property
+    def heading(self):
+        if self.state is None:
+            return None
+        length = np.hypot(*self.state)
+        if length == 0:
+            return None
+        return self.state / length
@@ -0,0 +1,155 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Runs a Navigator for each of several sessions (usually one per vehicle) in
+# a single process. All sessions share one sensor listener; sensor clients
+# select their session with SESSION_ID in sensors/config.py. Each session's
+# directions are spoken by its own speech process.
+#
+# Commands are read from standard input in the form "<session> <command>".
+# "<session>" alone requests an immediate direction.
+
+from . import directions
+from .directions import CACHE_DIR, METRICS_PORT, Navigator, SensorServer
+from .directions import fixed_messages, log, read_commands
+from .directions import serve_discovery, serve_metrics
+from .speech import SPEAK, SPEECH_COMMAND, AudioCache, SpeechOutput
+import asyncio
+import os
+import subprocess
+import sys
+import traceback
+
+LOG_PATH = os.path.join(CACHE_DIR, "host.log")
+
+
+class Host:
+    # If `auto_sessions` is true (by default, if `session_ids` is empty), a
+    # navigator is started for every new session that connects. Metrics are
+    # served on `metrics_port`, unless it is 0.
+    def __init__(
+            self, session_ids, auto_sessions=None,
+            metrics_port=METRICS_PORT):
+        if auto_sessions is None:
+            auto_sessions = not session_ids
+        self.metrics_port = metrics_port
+        self.server = SensorServer(
+            multi_session=True,
+            on_new_session=self.add_session if auto_sessions else None,
+        )
+        self.navigators = {}
+        self.speech_procs = []
+        self.speech_outputs = []
+        self.audio_cache = AudioCache()
+        self.tasks = []
+        # Set whenever a task is added.
+        self.tasks_changed = asyncio.Event()
+        for id in session_ids:
+            self.add_session(self.server.session(id))
+
+    def add_session(self, session):
+        navigator = Navigator(session, output=self.make_output())
+        self.navigators[session.id] = navigator
+        log("Added session: {}".format(session.id))
+        self.add_task(navigator.start())
+
+    # With SPEAK set, directions are spoken from cached audio where possible.
+    # Otherwise, each session gets a speech process that reads its output.
+    def make_output(self):
+        if SPEAK:
+            output = SpeechOutput(self.audio_cache, fixed_messages())
+            self.speech_outputs.append(output)
+            self.add_task(output.run())
+            return output
+        proc = subprocess.Popen(
+            SPEECH_COMMAND, stdin=subprocess.PIPE, encoding="utf8",
+            bufsize=1,
+        )
+        self.speech_procs.append(proc)
+        return proc.stdin
+
+    def handle_command(self, line):
+        id, _, cmd = line.partition(" ")
+        navigator = self.navigators.get(id)
+        if navigator is None:
+            print("Unknown session.", file=sys.stderr)
+            return
+        navigator.commands.put_nowait(cmd)
+
+    async def start(self):
+        await asyncio.gather(
+            self.server.start(),
+            read_commands(self.handle_command),
+            self.wait_for_navigators(),
+            serve_metrics(self.metrics_port),
+            serve_discovery(),
+        )
+
+    def add_task(self, coroutine):
+        self.tasks.append(asyncio.ensure_future(coroutine))
+        self.tasks_changed.set()
+
+    # Propagates exceptions from navigators, which may be added at any time.
+    async def wait_for_navigators(self):
+        while True:
+            self.tasks_changed.clear()
+            self.tasks = [task for task in self.tasks if not task.done()]
+            changed = asyncio.ensure_future(self.tasks_changed.wait())
+            try:
+                done, _ = await asyncio.wait(
+                    self.tasks + [changed],
+                    return_when=asyncio.FIRST_EXCEPTION,
+                )
+            finally:
+                changed.cancel()
+            for task in done:
+                if task is not changed:
+                    task.result()
+
+    def close(self):
+        for output in self.speech_outputs:
+            output.close()
+        for proc in self.speech_procs:
+            proc.stdin.close()
+            proc.wait()
+
+
+def run(session_ids):
+    log("Directions host starting...")
+    loop = asyncio.get_event_loop()
+    host = Host(session_ids)
+    try:
+        loop.run_until_complete(host.start())
+    finally:
+        host.close()
+
+
+def main():
+    with open(LOG_PATH, "a", encoding="utf8") as f:
+        directions.set_log_file(f)
+        try:
+            run(sys.argv[1:])
+        except (KeyboardInterrupt, EOFError):
+            sys.exit(0)
+        except Exception:
+            log(traceback.format_exc())
+            sys.exit(1)
+        directions.set_log_file(None)
+
+
+if __name__ == "__main__":
+    main()
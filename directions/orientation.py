@@ -0,0 +1,49 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+# Takes N×3 arrays of gravity and magnetism samples and returns an N×2 array
+# of horizontal directions along with a boolean array indicating which rows
+# are valid. Each row gets the same result as rotating the magnetism vector
+# with `Orientation.new_vec_to_vec(gravity, Vector(0, 0, 1))`, dropping the
+# z component and normalizing, but without creating any math3d objects.
+def compute_directions(gravity, magnetism):
+    gravity = np.asarray(gravity, dtype=float)
+    magnetism = np.asarray(magnetism, dtype=float)
+    length = np.linalg.norm(gravity, axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gx, gy, gz = (gravity / length[:, np.newaxis]).T
+        mx, my, mz = magnetism.T
+        # Closed form of the minimal rotation from gravity to the z axis,
+        # keeping only the x and y components.
+        cross = (gy * mx - gx * my) / (1 + gz)
+        x = mx * gz - gx * mz + gy * cross
+        y = my * gz - gy * mz - gx * cross
+
+        # math3d rotates about the y axis when gravity points straight down.
+        down = gz <= -1
+        x = np.where(down, -mx, x)
+        y = np.where(down, my, y)
+
+        horizontal = np.hypot(x, y)
+        directions = np.stack([x, y], axis=1) / horizontal[:, np.newaxis]
+
+    valid = (length > 0) & (horizontal > 0) & np.isfinite(horizontal)
+    return directions, valid
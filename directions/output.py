@@ -0,0 +1,82 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import enum
+import itertools
+
+
+class Priority(enum.IntEnum):
+    urgent = 0
+    direction = 1
+    info = 2
+
+
+class OutputItem:
+    def __init__(self, text, priority, order, supersede):
+        self.text = text
+        self.priority = priority
+        self.order = order
+        self.supersede = supersede
+
+    @property
+    def key(self):
+        return (self.priority, self.order)
+
+
+# Bounded queue of lines waiting to be output. Lines come out in order of
+# priority, and in the order they were added within each priority. A line
+# added with `supersede` replaces every queued line that was also added with
+# `supersede`. When the queue is full, the lowest-priority line is dropped
+# to make room, or the new line is dropped if it has the lowest priority.
+class OutputQueue:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = []
+        self.counter = itertools.count()
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self.items)
+
+    # Returns the lines that were superseded and the lines that were dropped
+    # because the queue was full.
+    def put(self, text, priority, supersede=False):
+        item = OutputItem(text, priority, next(self.counter), supersede)
+        superseded = []
+        if supersede:
+            superseded = [i.text for i in self.items if i.supersede]
+            self.items = [i for i in self.items if not i.supersede]
+        dropped = []
+        if len(self.items) >= self.max_size:
+            worst = max(self.items, key=lambda i: (i.priority, -i.order))
+            if worst.priority < item.priority:
+                return superseded, [text]
+            self.items.remove(worst)
+            dropped.append(worst.text)
+        self.items.append(item)
+        self.ready.set()
+        return superseded, dropped
+
+    async def get(self):
+        while not self.items:
+            self.ready.clear()
+            await self.ready.wait()
+        item = min(self.items, key=lambda i: i.key)
+        self.items.remove(item)
+        return item.text
@@ -0,0 +1,234 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Phrase packs: the lines the navigator says, loaded from JSON files so
+# that they can be changed without editing code. Each pack is a file named
+# after its locale (e.g., "en-US.json") in PHRASE_DIR, and contains:
+#
+#   "locale": the locale of the phrases.
+#   "actions", "immediate": for each action name, a list of [phrase,
+#   weight] pairs, one of which is chosen at random (with probability
+#   proportional to its weight) whenever the action is given.
+#   "start", "highway_start": lines said when starting or entering highway
+#   mode.
+#   "highway_exit", "highway_stop": the lines said when leaving highway
+#   mode.
+#
+# Packs are compiled into alias tables once, when they are loaded, so that
+# choosing a phrase takes constant time. A pack is reloaded if its file
+# changes.
+
+import json
+import os
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(__file__)
+PHRASE_DIR = os.environ.get("PHRASE_DIR") or os.path.join(
+    SCRIPT_DIR, "phrases",
+)
+DEFAULT_LOCALE = "en-US"
+# The pack used by default. Navigators can switch packs with the "phrases
+# <locale>" command.
+PHRASE_LOCALE = os.environ.get("PHRASE_LOCALE") or DEFAULT_LOCALE
+# Pack files are checked for changes at most this often, in seconds.
+CHECK_INTERVAL = 2
+
+
+class PhraseError(Exception):
+    pass
+
+
+# Samples indices with probabilities proportional to `weights` in constant
+# time, using Vose's alias method. Each index gets a slot that holds it with
+# probability `probabilities[i]` and its alias otherwise.
+class AliasSampler:
+    def __init__(self, weights):
+        weights = [float(w) for w in weights]
+        total = sum(weights)
+        if not weights or total <= 0 or min(weights) < 0:
+            raise ValueError("weights must be non-negative, with a sum > 0")
+        count = len(weights)
+        scaled = [w * count / total for w in weights]
+        self.probabilities = [1.0] * count
+        self.aliases = list(range(count))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        # Anything left over is only short of 1 because of rounding.
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    # A single random number chooses both the slot and whether to take its
+    # alias.
+    def sample(self, rng):
+        position = rng.random() * len(self.probabilities)
+        i = int(position)
+        if position - i < self.probabilities[i]:
+            return i
+        return self.aliases[i]
+
+
+class WeightedPhrases:
+    def __init__(self, pairs):
+        try:
+            self.phrases = [str(phrase) for phrase, _ in pairs]
+            self.sampler = AliasSampler(weight for _, weight in pairs)
+        except (TypeError, ValueError) as e:
+            raise PhraseError("Invalid phrases: {}".format(e))
+
+    def choose(self, rng):
+        return self.phrases[self.sampler.sample(rng)]
+
+
+def string_list(data, key):
+    value = data.get(key, [])
+    if not isinstance(value, list):
+        raise PhraseError("'{}' must be a list".format(key))
+    return [str(line) for line in value]
+
+
+class PhrasePack:
+    # `actions` and `immediate_actions` are the names of the actions the
+    # pack must have phrases for.
+    def __init__(self, data, actions, immediate_actions):
+        if not isinstance(data, dict):
+            raise PhraseError("A phrase pack must be an object")
+        self.locale = str(data.get("locale", ""))
+        self.actions = self.weighted(data, "actions", actions)
+        self.immediate = self.weighted(data, "immediate", immediate_actions)
+        self.start = string_list(data, "start")
+        self.highway_start = string_list(data, "highway_start")
+        try:
+            self.highway_exit = str(data["highway_exit"])
+            self.highway_stop = str(data["highway_stop"])
+        except KeyError as e:
+            raise PhraseError("Missing {}".format(e))
+
+    @staticmethod
+    def weighted(data, key, names):
+        table = data.get(key)
+        if not isinstance(table, dict):
+            raise PhraseError("'{}' must be an object".format(key))
+        missing = [name for name in names if name not in table]
+        if missing:
+            raise PhraseError("No {} phrases for: {}".format(
+                key, ", ".join(missing),
+            ))
+        return {name: WeightedPhrases(table[name]) for name in names}
+
+    @classmethod
+    def load(cls, path, actions, immediate_actions):
+        try:
+            with open(path, encoding="utf8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise PhraseError("{}: {}".format(path, e))
+        try:
+            return cls(data, actions, immediate_actions)
+        except PhraseError as e:
+            raise PhraseError("{}: {}".format(path, e))
+
+    # Every line the pack can produce.
+    def messages(self):
+        messages = [
+            phrase for table in (self.actions, self.immediate)
+            for phrases in table.values() for phrase in phrases.phrases
+        ]
+        messages += self.start + self.highway_start
+        messages += [self.highway_exit, self.highway_stop]
+        return messages
+
+
+class PackEntry:
+    def __init__(self, pack, path, mtime):
+        self.pack = pack
+        self.path = path
+        self.mtime = mtime
+        self.checked = time.monotonic()
+
+
+# Compiled packs by locale, shared by every navigator in the process. `log`
+# is called with a message when a changed pack can't be reloaded, in which
+# case the previous version is kept.
+class PhraseLibrary:
+    def __init__(
+            self, actions, immediate_actions, directory=PHRASE_DIR,
+            log=None):
+        self.actions = list(actions)
+        self.immediate_actions = list(immediate_actions)
+        self.directory = directory
+        self.log = log or (lambda message: print(message, file=sys.stderr))
+        self.entries = {}
+
+    # A locale can also be given as the path of a pack file.
+    def path(self, locale):
+        if os.sep in locale or locale.endswith(".json"):
+            return locale
+        return os.path.join(self.directory, locale + ".json")
+
+    def locales(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(
+            name[:-len(".json")] for name in names if name.endswith(".json")
+        )
+
+    def load(self, locale):
+        path = self.path(locale)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            raise PhraseError("No phrase pack for {}: {}".format(locale, e))
+        pack = PhrasePack.load(path, self.actions, self.immediate_actions)
+        return PackEntry(pack, path, mtime)
+
+    # Returns the pack for `locale`, loading it if needed, and reloading it
+    # if its file has changed. Raises PhraseError if it was never loaded
+    # successfully.
+    def get(self, locale):
+        entry = self.entries.get(locale)
+        if entry is None:
+            entry = self.load(locale)
+            self.entries[locale] = entry
+            return entry.pack
+        now = time.monotonic()
+        if now - entry.checked < CHECK_INTERVAL:
+            return entry.pack
+        entry.checked = now
+        try:
+            mtime = os.stat(entry.path).st_mtime_ns
+        except OSError:
+            return entry.pack
+        if mtime == entry.mtime:
+            return entry.pack
+        try:
+            self.entries[locale] = self.load(locale)
+        except (OSError, PhraseError) as e:
+            entry.mtime = mtime
+            self.log("Error reloading phrases: {}".format(e))
+            return entry.pack
+        self.log("Reloaded phrases: {}".format(locale))
+        return self.entries[locale].pack
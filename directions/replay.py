@@ -0,0 +1,95 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Runs the navigator with sensor data replayed from a capture file (recorded
+# by running with RECORD=1) instead of a sensor client. The navigator's clock
+# runs at the same speed as the replay. The target direction isn't loaded or
+# saved.
+
+from . import directions
+from .capture import Capture, CaptureError
+from .clock import Clock
+from .directions import CACHE_DIR, Navigator, SensorConnection, SensorServer
+from .directions import log, read_commands
+from sensors.protocol import DEFAULT_SESSION
+import argparse
+import asyncio
+import os
+import sys
+import traceback
+
+LOG_PATH = os.path.join(CACHE_DIR, "replay.log")
+
+
+async def replay(capture, speed):
+    server = SensorServer()
+    session = server.session(DEFAULT_SESSION)
+    connection = SensorConnection(
+        server, "replay:{}".format(os.path.basename(capture.path)),
+    )
+    connection.session = session
+    session.add(connection)
+    navigator = Navigator(session, clock=Clock(speed), persist=False)
+    tasks = [
+        asyncio.ensure_future(navigator.start()),
+        asyncio.ensure_future(read_commands(navigator.commands.put_nowait)),
+    ]
+    try:
+        await capture.replay(connection, speed)
+    finally:
+        for task in tasks:
+            task.cancel()
+    log("Replay finished.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m directions.replay")
+    parser.add_argument("capture", help="capture file to replay")
+    parser.add_argument(
+        "-s", "--speed", type=float, default=1,
+        help="playback speed (default: 1)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        capture = Capture(args.capture)
+    except (OSError, CaptureError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("Replaying {} records ({:.0f} s)".format(
+        len(capture), capture.duration,
+    ), file=sys.stderr)
+
+    with open(LOG_PATH, "a", encoding="utf8") as f:
+        directions.set_log_file(f)
+        try:
+            asyncio.get_event_loop().run_until_complete(
+                replay(capture, args.speed),
+            )
+        except (KeyboardInterrupt, EOFError):
+            sys.exit(0)
+        except Exception:
+            log(traceback.format_exc())
+            sys.exit(1)
+        directions.set_log_file(None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# A road network loaded from an OpenStreetMap extract (.osm, .osm.gz or
+# .osm.bz2), used to find the intersections a vehicle is approaching. Nodes
+# are projected onto a plane in meters around the middle of the extract, so
+# extracts should be at most a few hundred kilometers across.
+#
+# The graph is kept in flat arrays: `offsets`/`neighbors` is the adjacency of
+# every node in compressed sparse row form, with `allowed` saying whether
+# each neighbor can be driven to (one-way streets can't be driven against).
+# Road segments are indexed in a uniform grid of CELL_SIZE-meter cells,
+# stored as sorted cell keys with the segments of each cell, so that only
+# cells that contain roads take up space. Compiled graphs are cached as .npz
+# files, which load much faster than the extract.
+
+import argparse
+import bz2
+import gzip
+import math
+import numpy as np
+import os
+import random
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+
+EARTH_RADIUS = 6371000
+CELL_SIZE = 100
+# Locations further than this (in meters) from every road aren't snapped.
+# Must be at most 3/4 of CELL_SIZE, so that the roads within this distance
+# are always in the 3×3 cells around the location.
+MAX_SNAP_DISTANCE = 50
+# How many meters a heading that is perpendicular to a road counts for when
+# choosing the road a location is on.
+BEARING_PENALTY = 30
+# A location must be this many meters from the previous one to tell the
+# direction of travel from them.
+MIN_BEARING_DISTANCE = 10
+FORMAT_VERSION = 1
+
+ROAD_TYPES = {
+    "motorway", "trunk", "primary", "secondary", "tertiary",
+    "unclassified", "residential", "living_street",
+    "motorway_link", "trunk_link", "primary_link", "secondary_link",
+    "tertiary_link",
+}
+ONEWAY_ROAD_TYPES = {"motorway", "motorway_link"}
+CELL_KEY_OFFSET = 2 ** 31
+
+
+class RoadError(Exception):
+    pass
+
+
+# A position from the sensor client. `bearing` is the direction of travel in
+# degrees clockwise from north, or None if unknown. `time` is according to
+# `clock.now()`.
+class Location:
+    def __init__(self, latitude, longitude, bearing, time):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.bearing = bearing
+        self.time = time
+
+    # Fills in the bearing from `previous` if it isn't known and the
+    # locations are far enough apart.
+    def with_bearing_from(self, previous):
+        if self.bearing is not None or previous is None:
+            return self
+        north = math.radians(self.latitude - previous.latitude)
+        east = math.radians(self.longitude - previous.longitude) * math.cos(
+            math.radians(self.latitude),
+        )
+        if math.hypot(north, east) * EARTH_RADIUS < MIN_BEARING_DISTANCE:
+            return Location(
+                self.latitude, self.longitude, previous.bearing, self.time,
+            )
+        bearing = math.degrees(math.atan2(east, north)) % 360
+        return Location(self.latitude, self.longitude, bearing, self.time)
+
+
+# The intersection a vehicle is approaching, `distance` meters ahead. `turns`
+# are the angles (in radians, clockwise, like ACTION_ANGLES) of the roads
+# that can be taken from it, relative to the direction the vehicle will
+# arrive in. A dead end has no turns.
+class Intersection:
+    def __init__(self, node, distance, turns):
+        self.node = node
+        self.distance = distance
+        self.turns = turns
+
+
+def open_extract(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def is_oneway(tags):
+    oneway = tags.get("oneway")
+    if oneway in ("yes", "true", "1"):
+        return 1
+    if oneway == "-1":
+        return -1
+    if oneway == "no":
+        return 0
+    if tags.get("highway") in ONEWAY_ROAD_TYPES:
+        return 1
+    if tags.get("junction") == "roundabout":
+        return 1
+    return 0
+
+
+# Reads the drivable roads from an OSM XML extract. Returns the IDs and
+# coordinates of every node, and the node IDs of every road segment along
+# with whether it can be driven forwards and backwards.
+def read_extract(path):
+    node_ids, lats, lons = [], [], []
+    starts, ends, forwards, backwards = [], [], [], []
+    with open_extract(path) as f:
+        for _, elem in ElementTree.iterparse(f):
+            if elem.tag == "node":
+                node_ids.append(int(elem.get("id")))
+                lats.append(float(elem.get("lat")))
+                lons.append(float(elem.get("lon")))
+            elif elem.tag == "way":
+                tags = {
+                    tag.get("k"): tag.get("v") for tag in elem.iter("tag")
+                }
+                if tags.get("highway") in ROAD_TYPES:
+                    refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                    oneway = is_oneway(tags)
+                    starts += refs[:-1]
+                    ends += refs[1:]
+                    forwards += [oneway >= 0] * (len(refs) - 1)
+                    backwards += [oneway <= 0] * (len(refs) - 1)
+            else:
+                continue
+            elem.clear()
+    return (
+        np.array(node_ids, dtype=np.int64),
+        np.array(lats), np.array(lons),
+        np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+        np.array(forwards, dtype=bool), np.array(backwards, dtype=bool),
+    )
+
+
+# Returns the keys of the grid cells that contain `x` and `y`.
+def cell_keys(x, y):
+    return (
+        (np.floor(x / CELL_SIZE).astype(np.int64) + CELL_KEY_OFFSET) << 32
+    ) + np.floor(y / CELL_SIZE).astype(np.int64) + CELL_KEY_OFFSET
+
+
+class RoadGraph:
+    def __init__(self, arrays):
+        self.origin = arrays["origin"]
+        self.xy = arrays["xy"]
+        self.offsets = arrays["offsets"]
+        self.neighbors = arrays["neighbors"]
+        self.allowed = arrays["allowed"]
+        self.segments = arrays["segments"]
+        self.cells = arrays["cells"]
+        self.cell_offsets = arrays["cell_offsets"]
+        self.cell_segments = arrays["cell_segments"]
+        lat0 = math.radians(self.origin[0])
+        self.scale = np.array([
+            EARTH_RADIUS * math.cos(lat0), EARTH_RADIUS,
+        ]) * math.pi / 180
+
+    def __len__(self):
+        return len(self.xy)
+
+    @classmethod
+    def from_extract(cls, path):
+        node_ids, lats, lons, starts, ends, forwards, backwards = (
+            read_extract(path)
+        )
+        used = np.isin(starts, node_ids) & np.isin(ends, node_ids)
+        used &= starts != ends
+        if not used.any():
+            raise RoadError("No roads in {}".format(path))
+        starts, ends = starts[used], ends[used]
+        forwards, backwards = forwards[used], backwards[used]
+
+        # Keeps only the nodes on roads, numbered from 0.
+        ids = np.unique(np.concatenate([starts, ends]))
+        order = np.argsort(node_ids)
+        positions = order[np.searchsorted(node_ids, ids, sorter=order)]
+        lats, lons = lats[positions], lons[positions]
+        starts = np.searchsorted(ids, starts)
+        ends = np.searchsorted(ids, ends)
+
+        origin = np.array([
+            (lats.min() + lats.max()) / 2, (lons.min() + lons.max()) / 2,
+        ])
+        scale = EARTH_RADIUS * math.pi / 180
+        xy = np.stack([
+            (lons - origin[1]) * scale * math.cos(math.radians(origin[0])),
+            (lats - origin[0]) * scale,
+        ], axis=1)
+
+        # Each pair of nodes becomes one segment, from the lower-numbered
+        # node, drivable in whichever directions any of its ways allow.
+        flip = starts > ends
+        low = np.where(flip, ends, starts)
+        high = np.where(flip, starts, ends)
+        up = np.where(flip, backwards, forwards)
+        down = np.where(flip, forwards, backwards)
+        pairs, inverse = np.unique(
+            low * len(ids) + high, return_inverse=True,
+        )
+        segments = np.stack(
+            [pairs // len(ids), pairs % len(ids)], axis=1,
+        ).astype(np.int32)
+        up_any = np.zeros(len(pairs), dtype=bool)
+        down_any = np.zeros(len(pairs), dtype=bool)
+        np.logical_or.at(up_any, inverse, up)
+        np.logical_or.at(down_any, inverse, down)
+
+        sources = np.concatenate([segments[:, 0], segments[:, 1]])
+        targets = np.concatenate([segments[:, 1], segments[:, 0]])
+        allowed = np.concatenate([up_any, down_any])
+        order = np.argsort(sources, kind="stable")
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(ids)), out=offsets[1:])
+
+        arrays = {
+            "version": np.array(FORMAT_VERSION),
+            "origin": origin,
+            "xy": xy,
+            "offsets": offsets,
+            "neighbors": targets[order].astype(np.int32),
+            "allowed": allowed[order],
+            "segments": segments,
+        }
+        arrays.update(build_grid(xy, segments))
+        return cls(arrays)
+
+    @classmethod
+    def load_compiled(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != FORMAT_VERSION:
+                raise RoadError("Outdated road graph: {}".format(path))
+            return cls({name: data[name] for name in data.files})
+
+    def save(self, path):
+        temp_path = path + ".tmp.npz"
+        np.savez(
+            temp_path, version=np.array(FORMAT_VERSION), origin=self.origin,
+            xy=self.xy, offsets=self.offsets, neighbors=self.neighbors,
+            allowed=self.allowed, segments=self.segments, cells=self.cells,
+            cell_offsets=self.cell_offsets,
+            cell_segments=self.cell_segments,
+        )
+        os.replace(temp_path, path)
+
+    # Loads a compiled graph (.npz), or compiles an extract, using the copy
+    # in `cache_dir` if the extract hasn't changed since it was cached.
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        if path.endswith(".npz"):
+            return cls.load_compiled(path)
+        if cache_dir is None:
+            return cls.from_extract(path)
+        stat = os.stat(path)
+        name = "roads-{}-{}-{}.npz".format(
+            os.path.basename(path), stat.st_size, int(stat.st_mtime),
+        )
+        cache_path = os.path.join(cache_dir, name)
+        try:
+            return cls.load_compiled(cache_path)
+        except (OSError, ValueError, KeyError, RoadError):
+            pass
+        graph = cls.from_extract(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        graph.save(cache_path)
+        return graph
+
+    def project(self, latitude, longitude):
+        return (
+            np.array([longitude - self.origin[1], latitude - self.origin[0]])
+            * self.scale
+        )
+
+    # Returns the segments that may be within MAX_SNAP_DISTANCE of `point`.
+    def nearby_segments(self, point):
+        x, y = np.floor(point / CELL_SIZE).astype(np.int64)
+        keys = (
+            (np.array([x - 1, x, x + 1]) + CELL_KEY_OFFSET)[:, None] << 32
+        ) + (np.array([y - 1, y, y + 1]) + CELL_KEY_OFFSET)[None, :]
+        keys = keys.ravel()
+        indices = np.minimum(
+            np.searchsorted(self.cells, keys), len(self.cells) - 1,
+        )
+        indices = indices[self.cells[indices] == keys]
+        if len(indices) == 0:
+            return indices
+        return np.concatenate([
+            self.cell_segments[self.cell_offsets[i]:self.cell_offsets[i + 1]]
+            for i in indices
+        ])
+
+    # Finds the road segment the vehicle at `location` is most likely on.
+    # Returns (the node the vehicle is coming from, the node it is heading
+    # towards, the position on the segment), or None if there is no road
+    # nearby or the direction of travel isn't known.
+    def snap(self, location):
+        if location.bearing is None:
+            return None
+        point = self.project(location.latitude, location.longitude)
+        candidates = self.nearby_segments(point)
+        if len(candidates) == 0:
+            return None
+        ends = self.segments[candidates]
+        a = self.xy[ends[:, 0]]
+        b = self.xy[ends[:, 1]]
+        ab = b - a
+        lengths = np.maximum(np.einsum("ij,ij->i", ab, ab), 1e-9)
+        t = np.clip(np.einsum("ij,ij->i", point - a, ab) / lengths, 0, 1)
+        closest = a + ab * t[:, None]
+        distances = np.hypot(*(closest - point).T)
+
+        bearing = math.radians(location.bearing)
+        heading = np.array([math.sin(bearing), math.cos(bearing)])
+        alignment = (ab @ heading) / np.sqrt(lengths)
+        costs = distances + BEARING_PENALTY * (1 - np.abs(alignment))
+        costs[distances > MAX_SNAP_DISTANCE] = np.inf
+        best = int(np.argmin(costs))
+        if not np.isfinite(costs[best]):
+            return None
+        start, end = (int(n) for n in ends[best])
+        if alignment[best] < 0:
+            start, end = end, start
+        return start, end, closest[best]
+
+    # Roads leading from `node` other than the one to `previous`, as
+    # (neighbor, drivable) pairs.
+    def exits(self, node, previous):
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return [
+            (int(n), bool(ok)) for n, ok in zip(
+                self.neighbors[start:end], self.allowed[start:end],
+            ) if n != previous
+        ]
+
+    # Angle (clockwise) from the direction of a→b to that of b→c.
+    def turn_angle(self, a, b, c):
+        ax, ay = self.xy[b] - self.xy[a]
+        bx, by = self.xy[c] - self.xy[b]
+        return -math.atan2(ax * by - ay * bx, ax * bx + ay * by)
+
+    # Follows the road from the vehicle's location to the first intersection
+    # (a node with three or more roads) at least `min_distance` meters
+    # ahead, going straight through any closer ones. Returns an
+    # Intersection, or None if the location can't be snapped to a road or
+    # there's no intersection within `max_distance` meters.
+    def next_intersection(self, location, min_distance, max_distance):
+        snapped = self.snap(location)
+        if snapped is None:
+            return None
+        previous, node, point = snapped
+        distance = float(np.hypot(*(self.xy[node] - point)))
+        while distance <= max_distance:
+            exits = self.exits(node, previous)
+            if not exits:
+                return Intersection(node, distance, [])
+            if len(exits) == 1:
+                following = exits[0][0]
+            else:
+                turns = [
+                    (self.turn_angle(previous, node, n), n)
+                    for n, drivable in exits if drivable
+                ]
+                if distance >= min_distance:
+                    return Intersection(
+                        node, distance, [turn for turn, _ in turns],
+                    )
+                if not turns:
+                    return None
+                following = min(turns, key=lambda t: abs(t[0]))[1]
+            distance += float(np.hypot(*(self.xy[following] - self.xy[node])))
+            previous, node = node, following
+        return None
+
+
+# Indexes every segment in the grid cells it passes through, found by
+# sampling points along it at most a quarter of a cell apart.
+def build_grid(xy, segments):
+    a = xy[segments[:, 0]]
+    b = xy[segments[:, 1]]
+    lengths = np.hypot(*(b - a).T)
+    counts = np.ceil(lengths / (CELL_SIZE / 4)).astype(np.int64) + 1
+    segment_ids = np.repeat(np.arange(len(segments)), counts)
+    starts = np.cumsum(counts) - counts
+    steps = np.arange(len(segment_ids)) - np.repeat(starts, counts)
+    fractions = steps / np.repeat(np.maximum(counts - 1, 1), counts)
+    points = a[segment_ids] + (b - a)[segment_ids] * fractions[:, None]
+
+    keys = cell_keys(points[:, 0], points[:, 1])
+    pairs = np.unique(np.stack([keys, segment_ids], axis=1), axis=0)
+    cells, cell_starts = np.unique(pairs[:, 0], return_index=True)
+    return {
+        "cells": cells,
+        "cell_offsets": np.append(cell_starts, len(pairs)),
+        "cell_segments": pairs[:, 1].astype(np.int32),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m directions.roads")
+    parser.add_argument("map", help="OSM extract or compiled road graph")
+    parser.add_argument(
+        "-o", "--output", help="save the compiled graph to this .npz file",
+    )
+    parser.add_argument(
+        "-n", "--queries", type=int, default=10000,
+        help="number of random lookups to time (default: 10000)",
+    )
+    return parser.parse_args()
+
+
+# Compiles a road graph and measures how long it takes to find the next
+# intersection from random locations near its roads.
+def main():
+    args = parse_args()
+    start = time.perf_counter()
+    try:
+        graph = RoadGraph.load(args.map)
+    except (OSError, ElementTree.ParseError, RoadError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("Loaded {} nodes and {} segments in {:.2f} s".format(
+        len(graph), len(graph.segments), time.perf_counter() - start,
+    ))
+    if args.output:
+        graph.save(args.output)
+
+    times = []
+    found = 0
+    for _ in range(args.queries):
+        a, b = graph.segments[random.randrange(len(graph.segments))]
+        point = graph.xy[a] + (graph.xy[b] - graph.xy[a]) * random.random()
+        point += np.random.normal(0, 10, 2)
+        longitude, latitude = point / graph.scale + graph.origin[::-1]
+        location = Location(latitude, longitude, random.uniform(0, 360), 0)
+        query_start = time.perf_counter()
+        if graph.next_intersection(location, 30, 400) is not None:
+            found += 1
+        times.append(time.perf_counter() - query_start)
+    if times:
+        p50, p99 = np.percentile(times, [50, 99]) * 1e6
+        print("{} lookups, {} found an intersection".format(
+            len(times), found,
+        ))
+        print("p50: {:.0f} µs, p99: {:.0f} µs".format(p50, p99))
+
+
+if __name__ == "__main__":
+    main()
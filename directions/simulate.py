@@ -0,0 +1,218 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Runs the navigator against simulated trips in virtual time, with no
+# sensor connection and no real sleeping. Useful for tuning the constants in
+# directions.py, which can be overridden with --set NAME=VALUE.
+
+from . import directions
+from .clock import Clock, VirtualTimeLoop
+from .directions import ACTION_ANGLES, Navigator
+from .history import HeadingBuffer
+from math3d import Vector
+import argparse
+import ast
+import asyncio
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+MEASURE_INTERVAL = 10
+SAMPLE_INTERVAL = 1
+HISTORY_SIZE = 64
+REACTION_DELAY_RANGE = (2, 20)
+TURN_RATE = math.pi / 2 / 5
+WANDER = 0.03
+
+
+class NullOutput:
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+# Stands in for the sensor session of a vehicle that drives with a slowly
+# wandering heading and makes each turn it is told to after a random
+# reaction delay. The heading is advanced lazily whenever it is read, so
+# the simulation only wakes up when the navigator does. While the navigator
+# waits for sensor data, a sample is taken every SAMPLE_INTERVAL seconds.
+class SimulatedVehicle:
+    def __init__(self, clock):
+        self.id = "simulated"
+        self.clock = clock
+        self.heading = random.uniform(0, math.pi * 2)
+        self.time = clock.monotonic()
+        self.turns = []
+        self.remaining_turn = 0
+        self.actions = 0
+        self.history = HeadingBuffer(HISTORY_SIZE)
+        # Trips aren't placed on a road map.
+        self.location = None
+
+    async def ensure_ready(self):
+        pass
+
+    async def wait_for_update(self, timeout):
+        await asyncio.sleep(min(timeout, SAMPLE_INTERVAL))
+        self.update()
+        self.history.append(
+            self.clock.monotonic(),
+            (math.cos(self.heading), math.sin(self.heading)),
+        )
+
+    @property
+    def direction(self):
+        self.update()
+        return Vector(math.cos(self.heading), math.sin(self.heading))
+
+    def on_action(self, action):
+        self.actions += 1
+        angle = ACTION_ANGLES[action]
+        if angle == 0:
+            return
+        delay = random.uniform(*REACTION_DELAY_RANGE)
+        self.turns.append((self.clock.monotonic() + delay, angle))
+
+    def update(self):
+        now = self.clock.monotonic()
+        elapsed = now - self.time
+        if elapsed <= 0:
+            return
+        self.time = now
+        while self.turns and self.turns[0][0] <= now:
+            self.remaining_turn += self.turns.pop(0)[1]
+        max_turn = TURN_RATE * elapsed
+        turn = max(-max_turn, min(max_turn, self.remaining_turn))
+        self.remaining_turn -= turn
+        self.heading += turn + random.gauss(0, WANDER * math.sqrt(elapsed))
+
+
+class Trip:
+    def __init__(self):
+        self.clock = Clock()
+        self.vehicle = SimulatedVehicle(self.clock)
+        self.navigator = Navigator(
+            self.vehicle, output=NullOutput(), clock=self.clock,
+            persist=False, echo=False,
+        )
+        self.navigator.on_action = self.vehicle.on_action
+        self.quality_sum = 0
+        self.samples = 0
+
+    @property
+    def mean_quality(self):
+        return self.quality_sum / max(self.samples, 1)
+
+    async def measure(self):
+        while True:
+            self.quality_sum += self.navigator.quality()
+            self.samples += 1
+            await self.clock.sleep(MEASURE_INTERVAL)
+
+    async def run(self, duration):
+        measure_task = asyncio.ensure_future(self.measure())
+        try:
+            await asyncio.wait_for(self.navigator.navigation_loop(), duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            measure_task.cancel()
+        return self
+
+
+async def run_trips(count, duration, concurrency):
+    trips = []
+    while len(trips) < count:
+        batch = min(concurrency, count - len(trips))
+        trips += await asyncio.gather(*(
+            Trip().run(duration) for _ in range(batch)
+        ))
+    return trips
+
+
+def apply_override(assignment):
+    name, _, value = assignment.partition("=")
+    if not hasattr(directions, name):
+        raise SystemExit("Unknown constant: {}".format(name))
+    setattr(directions, name, ast.literal_eval(value))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m directions.simulate")
+    parser.add_argument(
+        "-n", "--trips", type=int, default=1000,
+        help="number of trips to simulate (default: 1000)",
+    )
+    parser.add_argument(
+        "-d", "--duration", type=float, default=3600,
+        help="length of each trip in simulated seconds (default: 3600)",
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=100,
+        help="number of trips to run at once (default: 100)",
+    )
+    parser.add_argument("-s", "--seed", type=int, help="random seed")
+    parser.add_argument(
+        "--set", action="append", default=[], metavar="NAME=VALUE",
+        help="override a constant in directions.py",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for assignment in args.set:
+        apply_override(assignment)
+    directions.DECISION_ENGINE = directions.make_decision_engine()
+    random.seed(args.seed)
+
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+    with open(os.devnull, "w") as f:
+        directions.set_log_file(f)
+        start = time.perf_counter()
+        trips = loop.run_until_complete(
+            run_trips(args.trips, args.duration, args.concurrency),
+        )
+        elapsed = time.perf_counter() - start
+        directions.set_log_file(None)
+    loop.close()
+
+    qualities = [trip.mean_quality for trip in trips]
+    hours = args.duration / 3600
+    print("Trips: {} ({:.0f} per second)".format(
+        len(trips), len(trips) / elapsed,
+    ))
+    print("Mean quality: {:.4f} (stdev {:.4f})".format(
+        statistics.mean(qualities),
+        statistics.pstdev(qualities),
+    ))
+    print("Actions per hour: {:.1f}".format(
+        statistics.mean(trip.vehicle.actions for trip in trips) / hours,
+    ))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(1)
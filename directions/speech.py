@@ -0,0 +1,152 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+
+# Speaks the navigator's output directly instead of through a pipe to a
+# speech program. The navigator's fixed messages are synthesized ahead of
+# time into audio clips in .cache/speech, so speaking one of them only
+# requires playing a file. Other lines are synthesized as they are spoken.
+
+from .directions import CACHE_DIR, METRICS, log
+import asyncio
+import hashlib
+import os
+import shlex
+
+# If set, the navigator speaks its output itself.
+SPEAK = bool(os.environ.get("SPEAK"))
+# Must accept the text as its last argument, and "-w <file>" to write a WAV
+# file instead of speaking (as espeak-ng does).
+SPEECH_COMMAND = shlex.split(
+    os.environ.get("SPEECH_COMMAND", "espeak-ng -v en-US"),
+)
+PLAY_COMMAND = shlex.split(os.environ.get("PLAY_COMMAND", "aplay -q"))
+SPEECH_CACHE_DIR = os.path.join(CACHE_DIR, "speech")
+
+LINES_SPOKEN = METRICS.counter(
+    "directions_lines_spoken_total",
+    "Lines spoken, by where the audio came from", ["source"],
+)
+
+
+# Audio clips keyed by the text and the synthesis command (which selects the
+# voice).
+class AudioCache:
+    def __init__(self, command=SPEECH_COMMAND, directory=SPEECH_CACHE_DIR):
+        self.command = command
+        self.directory = directory
+        # Clips currently being synthesized.
+        self.pending = {}
+
+    def path(self, text):
+        key = "\0".join(self.command + [text]).encode("utf8")
+        name = hashlib.sha256(key).hexdigest()[:32]
+        return os.path.join(self.directory, name + ".wav")
+
+    def get(self, text):
+        path = self.path(text)
+        return path if os.path.exists(path) else None
+
+    async def render(self, text):
+        path = self.path(text)
+        if os.path.exists(path):
+            return
+        task = self.pending.get(path)
+        if task is None:
+            task = asyncio.ensure_future(self.synthesize(text, path))
+            self.pending[path] = task
+            task.add_done_callback(lambda _: self.pending.pop(path, None))
+        await asyncio.shield(task)
+
+    async def synthesize(self, text, path):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self.command, "-w", temp_path, text,
+            )
+        except OSError as e:
+            log("Error starting speech synthesis: {}".format(e))
+            return
+        # Whatever was written is removed unless it was moved into place.
+        try:
+            if await proc.wait() != 0 or not os.path.exists(temp_path):
+                log("Could not synthesize: {}".format(text))
+                return
+            os.replace(temp_path, path)
+        finally:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+
+    # Synthesizes every phrase that isn't cached yet, one at a time.
+    async def prepare(self, phrases):
+        for text in phrases:
+            await self.render(text)
+
+
+# Speaks the lines passed to `speak`, playing cached audio when it exists.
+# `run` synthesizes `phrases` into the cache, and `prepare` synthesizes new
+# phrases later (e.g., when the phrases change) in the background.
+class SpeechOutput:
+    def __init__(self, cache, phrases=(), player=PLAY_COMMAND):
+        self.cache = cache
+        self.phrases = list(phrases)
+        self.player = player
+        self.proc = None
+        self.preparing = None
+
+    async def run(self):
+        await self.cache.prepare(self.phrases)
+
+    # Replaces any preparation that is still running.
+    def prepare(self, phrases):
+        if self.preparing is not None:
+            self.preparing.cancel()
+        self.phrases = list(phrases)
+        self.preparing = asyncio.ensure_future(self.run())
+
+    async def speak(self, text):
+        text = text.strip()
+        if not text:
+            return
+        path = self.cache.get(text)
+        if path is not None and self.player:
+            if await self.run_command(self.player + [path]):
+                LINES_SPOKEN.inc(source="cache")
+                return
+            log("Playing audio failed; disabling cached audio")
+            self.player = None
+        if await self.run_command(self.cache.command + [text]):
+            LINES_SPOKEN.inc(source="live")
+
+    async def run_command(self, args):
+        try:
+            self.proc = await asyncio.create_subprocess_exec(*args)
+        except OSError as e:
+            log("Error running {}: {}".format(args[0], e))
+            return False
+        try:
+            return await self.proc.wait() == 0
+        finally:
+            self.close()
+            self.proc = None
+
+    def close(self):
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.kill()
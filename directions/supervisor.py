@@ -0,0 +1,332 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Runs the directions host in several worker processes. The supervisor owns
+# the listening socket, peeks at the hello message of every new connection,
+# and hands the connection to the worker that owns its session ID, so that
+# each session always stays on the same worker. Commands from standard input
+# ("<session> <command>", as in the host) are forwarded the same way.
+# Workers that crash are restarted.
+
+from . import directions
+from .directions import CACHE_DIR, HOST, METRICS
+from .directions import log, read_commands, serve_discovery, serve_metrics
+from .host import Host
+from sensors.config import PORT
+from sensors.protocol import DEFAULT_SESSION, MAX_HELLO_SIZE
+from sensors.protocol import peek_session_id
+import argparse
+import array
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import traceback
+import zlib
+
+LOG_PATH = os.path.join(CACHE_DIR, "supervisor.log")
+WORKER_LOG_PATH = os.path.join(CACHE_DIR, "worker-{}.log")
+
+HELLO_TIMEOUT = 2
+RESTART_DELAY = 1
+# Worker N serves its metrics on WORKER_METRICS_PORT + N (0 disables them).
+WORKER_METRICS_PORT = 9111
+PARENT_CHECK_INTERVAL = 1
+MESSAGE_SIZE = 4096
+
+MESSAGE_CONNECTION = b"F"
+MESSAGE_COMMAND = b"C"
+
+CONNECTIONS_HANDED_OFF = METRICS.counter(
+    "directions_connections_handed_off_total",
+    "Sensor connections handed to each worker", ["worker"],
+)
+WORKER_RESTARTS = METRICS.counter(
+    "directions_worker_restarts_total", "Worker restarts after crashes",
+    ["worker"],
+)
+
+
+def worker_index(session_id, worker_count):
+    return zlib.crc32(session_id.encode("utf8")) % worker_count
+
+
+def send_message(channel, kind, data=b"", fd=None):
+    ancillary = []
+    if fd is not None:
+        fds = array.array("i", [fd])
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)]
+    channel.sendmsg([kind + data], ancillary)
+
+
+def receive_message(channel):
+    fds = array.array("i")
+    data, ancillary, _, _ = channel.recvmsg(
+        MESSAGE_SIZE, socket.CMSG_LEN(fds.itemsize),
+    )
+    for level, type, cmsg_data in ancillary:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:fds.itemsize])
+    return data[:1], data[1:], (fds[0] if fds else None)
+
+
+async def wait_readable(sock):
+    loop = asyncio.get_event_loop()
+    readable = loop.create_future()
+
+    def on_readable():
+        if not readable.done():
+            readable.set_result(None)
+
+    loop.add_reader(sock, on_readable)
+    try:
+        await readable
+    finally:
+        loop.remove_reader(sock)
+
+
+class Worker:
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.channel = None
+
+    async def run(self):
+        while True:
+            channel, child_channel = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_DGRAM,
+            )
+            fd = child_channel.fileno()
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-u", "-m", "directions.supervisor",
+                "--workers", str(len(self.supervisor.workers)),
+                "--worker-index", str(self.index),
+                "--worker-fd", str(fd),
+                *self.supervisor.session_ids,
+                stdin=subprocess.DEVNULL, pass_fds=[fd],
+            )
+            child_channel.close()
+            self.channel = channel
+            log("Started worker {} (pid {})".format(self.index, proc.pid))
+            code = await proc.wait()
+            self.channel = None
+            channel.close()
+            if code == 0:
+                return
+            log("Worker {} exited with code {}. Restarting...".format(
+                self.index, code,
+            ))
+            WORKER_RESTARTS.inc(worker=self.index)
+            await asyncio.sleep(RESTART_DELAY)
+
+    def send(self, kind, data=b"", fd=None):
+        if self.channel is None:
+            log("Worker {} is not running".format(self.index))
+            return False
+        try:
+            send_message(self.channel, kind, data, fd)
+        except OSError as e:
+            log("Error sending to worker {}: {}".format(self.index, e))
+            return False
+        return True
+
+
+class Supervisor:
+    def __init__(self, worker_count, session_ids):
+        self.session_ids = session_ids
+        self.workers = [Worker(self, i) for i in range(worker_count)]
+        self.listener = None
+
+    def worker(self, session_id):
+        return self.workers[worker_index(session_id, len(self.workers))]
+
+    async def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((HOST, PORT))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        log("Supervisor started")
+        await asyncio.gather(
+            self.accept_loop(),
+            read_commands(self.handle_command),
+            serve_metrics(),
+            serve_discovery(),
+            *(worker.run() for worker in self.workers),
+        )
+
+    async def accept_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            sock, _ = await loop.sock_accept(self.listener)
+            asyncio.ensure_future(self.dispatch(sock))
+
+    async def dispatch(self, sock):
+        with sock:
+            session_id = await self.peek_session_id(sock)
+            worker = self.worker(session_id)
+            log("Handing session {} to worker {}".format(
+                session_id, worker.index,
+            ))
+            if worker.send(MESSAGE_CONNECTION, fd=sock.fileno()):
+                CONNECTIONS_HANDED_OFF.inc(worker=worker.index)
+
+    async def peek_session_id(self, sock):
+        try:
+            return await asyncio.wait_for(
+                self.peek_hello(sock), HELLO_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            return DEFAULT_SESSION
+        finally:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, 1)
+            except OSError:
+                pass
+
+    # The hello message is left in the socket for the worker. While only
+    # part of it has arrived, SO_RCVLOWAT keeps the socket from becoming
+    # readable again until more data arrives.
+    async def peek_hello(self, sock):
+        while True:
+            await wait_readable(sock)
+            try:
+                data = sock.recv(MAX_HELLO_SIZE, socket.MSG_PEEK)
+            except BlockingIOError:
+                continue
+            except OSError:
+                return DEFAULT_SESSION
+            if not data:
+                return DEFAULT_SESSION
+            session_id = peek_session_id(data)
+            if session_id is not None:
+                return session_id
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVLOWAT, len(data) + 1,
+            )
+
+    def handle_command(self, line):
+        session_id = line.partition(" ")[0]
+        self.worker(session_id).send(MESSAGE_COMMAND, line.encode("utf8"))
+
+
+class WorkerHost(Host):
+    def __init__(self, session_ids, auto_sessions, channel, index):
+        metrics_port = WORKER_METRICS_PORT and WORKER_METRICS_PORT + index
+        super().__init__(session_ids, auto_sessions, metrics_port)
+        self.channel = channel
+        self.parent_pid = os.getppid()
+
+    async def start(self):
+        await asyncio.gather(
+            self.receive_messages(),
+            self.wait_for_navigators(),
+            self.watch_parent(),
+            serve_metrics(self.metrics_port),
+        )
+
+    async def receive_messages(self):
+        loop = asyncio.get_event_loop()
+        messages = asyncio.Queue()
+        self.channel.setblocking(False)
+
+        def on_readable():
+            try:
+                messages.put_nowait(receive_message(self.channel))
+            except BlockingIOError:
+                pass
+
+        loop.add_reader(self.channel, on_readable)
+        while True:
+            kind, data, fd = await messages.get()
+            if kind == MESSAGE_CONNECTION and fd is not None:
+                sock = socket.socket(fileno=fd)
+                asyncio.ensure_future(self.server.adopt(sock))
+            elif kind == MESSAGE_COMMAND:
+                self.handle_command(data.decode("utf8"))
+
+    async def watch_parent(self):
+        while os.getppid() == self.parent_pid:
+            await asyncio.sleep(PARENT_CHECK_INTERVAL)
+        log("Supervisor exited")
+        raise EOFError
+
+
+def run_supervisor(args):
+    log("Supervisor starting...")
+    loop = asyncio.get_event_loop()
+    supervisor = Supervisor(args.workers, args.sessions)
+    loop.run_until_complete(supervisor.start())
+
+
+def run_worker(args):
+    log("Worker {} starting...".format(args.worker_index))
+    loop = asyncio.get_event_loop()
+    session_ids = [
+        id for id in args.sessions
+        if worker_index(id, args.workers) == args.worker_index
+    ]
+    channel = socket.socket(fileno=args.worker_fd)
+    host = WorkerHost(
+        session_ids, not args.sessions, channel, args.worker_index,
+    )
+    try:
+        loop.run_until_complete(host.start())
+    finally:
+        host.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python3 -m directions.supervisor")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count() or 1,
+        help="number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "sessions", nargs="*",
+        help="session IDs to serve (default: all that connect)",
+    )
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-fd", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    is_worker = args.worker_fd is not None
+    if is_worker:
+        path = WORKER_LOG_PATH.format(args.worker_index)
+    else:
+        path = LOG_PATH
+    with open(path, "a", encoding="utf8") as f:
+        directions.set_log_file(f)
+        try:
+            if is_worker:
+                run_worker(args)
+            else:
+                run_supervisor(args)
+        except (KeyboardInterrupt, EOFError):
+            sys.exit(0)
+        except Exception:
+            log(traceback.format_exc())
+            sys.exit(1)
+        directions.set_log_file(None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Stores the local IPs of navigators, so that sensor clients can find them.
+# Each IP is stored under a name, given by the URL path ("/" is "default"):
+#
+#   POST /<name> with the form field "ip" sets the IP.
+#   GET /<name> returns the IP, with the IP (quoted) as its ETag.
+#   GET /<name>?wait=<seconds> with "If-None-Match: <ETag>" waits until the
+#   IP is different from the ETag, for at most the given number of seconds
+#   (capped at MAX_WAIT). If it doesn't change, the reply is 304 Not
+#   Modified.
+#
+# Entries are kept in memory and saved to SNAPSHOT_PATH shortly after they
+# change. Connections are kept alive between requests.
+
+from urllib.parse import parse_qs, unquote, urlsplit
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import re
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(__file__)
+SNAPSHOT_PATH = os.path.join(SCRIPT_DIR, "registry.json")
+HOST = "0.0.0.0"
+PORT = 9003
+
+DEFAULT_NAME = "default"
+NAME_REGEX = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+MAX_ENTRIES = 10000
+MAX_REQUEST_SIZE = 8192
+# Idle keep-alive connections are closed after this many seconds.
+IDLE_TIMEOUT = 60
+MAX_WAIT = 55
+# Entries are saved at most this long (in seconds) after they change.
+SAVE_DELAY = 1
+
+STATUS_TEXT = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    507: "Insufficient Storage",
+}
+
+
+def log(*args, **kwargs):
+    print(*args, file=sys.stderr, flush=True, **kwargs)
+
+
+class RequestError(Exception):
+    def __init__(self, status, message=""):
+        super().__init__(message)
+        self.status = status
+
+
+def etag(ip):
+    return '"{}"'.format(ip)
+
+
+def parse_ip(text):
+    try:
+        return str(ipaddress.ip_address(text.strip()))
+    except ValueError:
+        raise RequestError(400, "Error: Invalid IP.")
+
+
+class Registry:
+    def __init__(self, path):
+        self.path = path
+        # Maps names to (IP, time last set).
+        self.entries = {}
+        # Maps names to futures that are resolved when the IP changes.
+        self.changes = {}
+        self.save_handle = None
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.entries = {
+            name: (entry["ip"], entry["time"]) for name, entry in data.items()
+        }
+        log("Loaded {} entries".format(len(self.entries)))
+
+    def save(self):
+        self.save_handle = None
+        data = {
+            name: {"ip": ip, "time": t}
+            for name, (ip, t) in self.entries.items()
+        }
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf8") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log("Error saving entries: {}".format(e))
+
+    def schedule_save(self):
+        if self.save_handle is None:
+            loop = asyncio.get_event_loop()
+            self.save_handle = loop.call_later(SAVE_DELAY, self.save)
+
+    def flush(self):
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+            self.save()
+
+    def get(self, name):
+        entry = self.entries.get(name)
+        return None if entry is None else entry[0]
+
+    # Setting the same IP again only updates the entry's time.
+    def set(self, name, ip):
+        if name not in self.entries and len(self.entries) >= MAX_ENTRIES:
+            raise RequestError(507, "Error: Too many entries.")
+        old_ip = self.get(name)
+        self.entries[name] = (ip, time.time())
+        self.schedule_save()
+        if ip == old_ip:
+            return
+        log("{}: {}".format(name, ip))
+        change = self.changes.pop(name, None)
+        if change is not None and not change.done():
+            change.set_result(None)
+
+    # Waits until the IP of `name` is not `ip`, or until `timeout` expires.
+    async def wait_for_change(self, name, ip, timeout):
+        if self.get(name) != ip:
+            return
+        change = self.changes.get(name)
+        if change is None:
+            change = asyncio.get_event_loop().create_future()
+            self.changes[name] = change
+        try:
+            await asyncio.wait_for(asyncio.shield(change), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        url = urlsplit(target)
+        self.path = unquote(url.path)
+        self.query = parse_qs(url.query)
+        self.headers = headers
+        self.body = body
+
+    @property
+    def name(self):
+        name = self.path.strip("/") or DEFAULT_NAME
+        if not NAME_REGEX.fullmatch(name):
+            raise RequestError(404)
+        return name
+
+
+async def read_request(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise RequestError(400)
+    headers = {}
+    for line in lines[1:]:
+        key, sep, value = line.partition(":")
+        if sep:
+            headers[key.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise RequestError(400)
+    if not 0 <= length <= MAX_REQUEST_SIZE:
+        raise RequestError(413)
+    body = await reader.readexactly(length)
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection == "keep-alive" or (
+        version == "HTTP/1.1" and connection != "close"
+    )
+    return Request(method, target, headers, body), keep_alive
+
+
+def http_response(status, body="", headers=(), keep_alive=True):
+    body = body.encode("utf8")
+    lines = [
+        "HTTP/1.1 {} {}".format(status, STATUS_TEXT[status]),
+        "Content-Type: text/plain; charset=utf-8",
+        "Content-Length: {}".format(len(body)),
+        "Cache-Control: no-cache",
+        "Connection: {}".format("keep-alive" if keep_alive else "close"),
+    ]
+    lines += ["{}: {}".format(*header) for header in headers]
+    return "\r\n".join(lines + ["", ""]).encode("latin-1") + body
+
+
+class Server:
+    def __init__(self, registry):
+        self.registry = registry
+
+    async def handle(self, request):
+        name = request.name
+        if request.method == "POST":
+            fields = parse_qs(request.body.decode("utf8", "replace"))
+            if "ip" not in fields:
+                raise RequestError(
+                    400, "Error: 'ip' parameter was not provided.",
+                )
+            self.registry.set(name, parse_ip(fields["ip"][0]))
+            return 200, "Success", ()
+        if request.method != "GET":
+            raise RequestError(405)
+
+        known = request.headers.get("if-none-match")
+        wait = request.query.get("wait")
+        if known is not None and wait is not None:
+            try:
+                timeout = min(max(float(wait[0]), 0), MAX_WAIT)
+            except ValueError:
+                raise RequestError(400)
+            await self.registry.wait_for_change(
+                name, known.strip('"'), timeout,
+            )
+        ip = self.registry.get(name)
+        if ip is None:
+            raise RequestError(404)
+        if known == etag(ip):
+            return 304, "", [("ETag", etag(ip))]
+        return 200, ip + "\n", [("ETag", etag(ip))]
+
+    # Returns the response to the next request on the connection, and
+    # whether to keep the connection open.
+    async def respond(self, reader):
+        try:
+            request, keep_alive = await asyncio.wait_for(
+                read_request(reader), IDLE_TIMEOUT,
+            )
+        except RequestError as e:
+            return http_response(e.status, str(e), keep_alive=False), False
+        try:
+            status, body, headers = await self.handle(request)
+        except RequestError as e:
+            status, body, headers = e.status, str(e), ()
+        return http_response(status, body, headers, keep_alive), keep_alive
+
+    async def on_connect(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                response, keep_alive = await self.respond(reader)
+                writer.write(response)
+                await writer.drain()
+        except (
+            asyncio.TimeoutError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError, ValueError, OSError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, host, port):
+        server = await asyncio.start_server(
+            self.on_connect, host, port, limit=MAX_REQUEST_SIZE,
+        )
+        log("Registry started on port {}".format(port))
+        async with server:
+            await server.serve_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="registry.py")
+    parser.add_argument(
+        "-H", "--host", default=HOST,
+        help="address to listen on (default: {})".format(HOST),
+    )
+    parser.add_argument(
+        "-p", "--port", type=int, default=PORT,
+        help="port to listen on (default: {})".format(PORT),
+    )
+    parser.add_argument(
+        "-s", "--snapshot", default=SNAPSHOT_PATH,
+        help="file in which entries are saved (default: registry.json)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    registry = Registry(args.snapshot)
+    registry.load()
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(Server(registry).run(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        registry.flush()
+
+
+if __name__ == "__main__":
+    main()
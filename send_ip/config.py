@@ -5,4 +5,4 @@
 # CC0 Public Domain Dedication.
 
 HOST = "example.local"
-SET_URL = "https://example.local/local-ip/set.py"
+SET_URL = "https://example.local/local-ip/"
@@ -15,44 +15,223 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with random-directions. If not, see <https://www.gnu.org/licenses/>.
 
+# Publishes the local IP of this device to SET_URL (see local-ip/registry.py)
+# whenever it changes, and every HEARTBEAT_INTERVAL seconds otherwise. The
+# IP is the source address used to reach HOST, which is checked whenever the
+# kernel reports an address or route change over netlink (where available)
+# and every CHECK_INTERVAL seconds.
+
 from .config import HOST, SET_URL
-from urllib.parse import urlencode
-from urllib.request import Request, urlopen
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlencode, urlsplit
+import asyncio
 import os
+import random
 import socket
 import sys
-import time
 
 DEBUG = bool(os.environ.get("DEBUG"))
 
+CHECK_INTERVAL = 2
+# Used instead of CHECK_INTERVAL when address changes are reported over
+# netlink.
+NETLINK_CHECK_INTERVAL = 30
+HEARTBEAT_INTERVAL = 300
+TIMEOUT = 15
+# Failed attempts to publish are retried after a random delay of up to
+# RETRY_DELAY seconds, which doubles after every failure, up to
+# MAX_RETRY_DELAY.
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+# Multicast groups for link, IPv4 address and IPv4 route changes.
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
 
-def get_ip():
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+def open_netlink():
+    if not hasattr(socket, "AF_NETLINK"):
+        return None
     try:
-        s.connect((HOST, 1))
-        ip = s.getsockname()[0]
-        return ip
-    finally:
-        s.close()
+        sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE,
+        )
+    except OSError:
+        return None
+    try:
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+    except OSError:
+        sock.close()
+        return None
+    sock.setblocking(False)
+    return sock
 
 
-def send_ip(ip):
-    fields = {"ip": ip}
-    request = Request(SET_URL, urlencode(fields).encode("utf8"))
-    with urlopen(request) as r:
-        return r.read().decode("utf8").rstrip("\r\n")
+class AddressMonitor:
+    def __init__(self, host):
+        self.host = host
+        self.address = None
+        self.changed = asyncio.Event()
+        self.netlink = open_netlink()
+        self.interval = CHECK_INTERVAL
+        if self.netlink is not None:
+            self.interval = NETLINK_CHECK_INTERVAL
+            asyncio.get_event_loop().add_reader(
+                self.netlink, self.on_netlink,
+            )
 
+    def on_netlink(self):
+        try:
+            while self.netlink.recv(65536):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        self.changed.set()
 
-def run():
-    print("Started", file=sys.stderr)
-    any_success = False
-    while True:
+    # Returns the IP used to reach `host`, or None if it can't be reached.
+    # Connecting a UDP socket doesn't send anything. `host` is looked up
+    # only once, or again after an error.
+    async def get_ip(self):
+        loop = asyncio.get_event_loop()
         try:
-            response = send_ip(get_ip())
-        except OSError as e:
+            if self.address is None:
+                info = await loop.getaddrinfo(
+                    self.host, 1, family=socket.AF_INET,
+                    type=socket.SOCK_DGRAM,
+                )
+                self.address = info[0][4]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect(self.address)
+                return s.getsockname()[0]
+        except OSError:
+            self.address = None
+            return None
+
+    # Waits until an address change is reported, the check interval passes,
+    # or `timeout` expires, whichever comes first.
+    async def wait(self, timeout=None):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.changed.clear()
+
+
+# Sends IPs to `url` over a single keep-alive connection. `send` blocks, so
+# it is run in an executor.
+class Sender:
+    def __init__(self, url):
+        url = urlsplit(url)
+        self.connection_class = HTTPConnection
+        if url.scheme == "https":
+            self.connection_class = HTTPSConnection
+        self.host = url.netloc
+        self.path = url.path or "/"
+        if url.query:
+            self.path += "?" + url.query
+        self.connection = None
+
+    def send(self, ip):
+        # A kept-alive connection may have been closed by the server, so a
+        # request on one that fails is retried on a new connection.
+        reused = self.connection is not None
+        try:
+            status, text = self.request(ip)
+        except (HTTPException, OSError):
+            if not reused:
+                raise
+            status, text = self.request(ip)
+        if status != 200:
+            raise HTTPException("%s %s" % (status, text))
+        return text
+
+    def request(self, ip):
+        if self.connection is None:
+            self.connection = self.connection_class(
+                self.host, timeout=TIMEOUT,
+            )
+        try:
+            self.connection.request(
+                "POST", self.path, urlencode({"ip": ip}),
+                {"Content-Type": "application/x-www-form-urlencoded"},
+            )
+            response = self.connection.getresponse()
+            text = response.read().decode("utf8").rstrip("\r\n")
+        except (HTTPException, OSError):
+            self.close()
+            raise
+        if response.will_close:
+            self.close()
+        return response.status, text
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Publisher:
+    def __init__(self):
+        self.monitor = AddressMonitor(HOST)
+        self.sender = Sender(SET_URL)
+        self.published = None
+        self.last_publish = None
+        self.failures = 0
+        self.retry_time = None
+        self.any_success = False
+
+    def is_due(self, ip, now):
+        if ip is None:
+            return False
+        if ip != self.published:
+            return True
+        return now - self.last_publish >= HEARTBEAT_INTERVAL
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        last_ip = None
+        while True:
+            ip = await self.monitor.get_ip()
+            if ip != last_ip:
+                # The network changed, so there's no need to wait before
+                # retrying.
+                self.retry_time = None
+                last_ip = ip
+            now = loop.time()
+            retrying = self.retry_time is not None and now < self.retry_time
+            if self.is_due(ip, now) and not retrying:
+                await self.publish(ip)
+            timeout = None
+            if self.retry_time is not None:
+                timeout = max(self.retry_time - loop.time(), 0)
+            await self.monitor.wait(timeout)
+
+    async def publish(self, ip):
+        loop = asyncio.get_event_loop()
+        try:
+            response = await loop.run_in_executor(None, self.sender.send, ip)
+        except (HTTPException, OSError) as e:
             print("%s: %s" % (type(e).__name__, e), file=sys.stderr)
-        else:
-            if DEBUG or not any_success:
-                print("Response: %s" % response, file=sys.stderr)
-            any_success = True
-        time.sleep(15)
+            delay = min(RETRY_DELAY * 2 ** self.failures, MAX_RETRY_DELAY)
+            self.failures += 1
+            self.retry_time = loop.time() + random.uniform(0, delay)
+            return
+        self.published = ip
+        self.last_publish = loop.time()
+        self.failures = 0
+        self.retry_time = None
+        if DEBUG or not self.any_success:
+            print("Response: %s" % response, file=sys.stderr)
+        self.any_success = True
+
+
+def run():
+    print("Started", file=sys.stderr)
+    publisher = Publisher()
+    try:
+        asyncio.get_event_loop().run_until_complete(publisher.run())
+    finally:
+        publisher.sender.close()
@@ -16,10 +16,75 @@ MAGNETOMETER = "Magnetometer"
 # The name of the gravity sensor
 GRAVITY = "Gravity"
 
+# Identifies the vehicle this sensor client belongs to, when a navigator host
+# runs directions for several vehicles
+SESSION_ID = "default"
+
+# "binary" to send packed sensor frames, or "json" to send them in the same
+# JSON format as termux-sensor
+PROTOCOL = "binary"
+
+# Where sensor data comes from: "termux" (termux-sensor), or "synthetic" to
+# generate it, e.g., to load-test the sensor client on a computer. Can be
+# overridden with the SENSOR_SOURCE environment variable
+SENSOR_SOURCE = "termux"
+
+# Milliseconds between sensor samples (the -d option of termux-sensor), or
+# None for the default. Longer delays save battery and network traffic.
+# Can be overridden with the SENSOR_DELAY environment variable
+SENSOR_DELAY = None
+
+# Sending SIGUSR1 to the sensor client doubles the delay, and SIGUSR2 halves
+# it, within MIN_SENSOR_DELAY and MAX_SENSOR_DELAY. If no delay is set,
+# DEFAULT_SENSOR_DELAY is used as the starting point
+MIN_SENSOR_DELAY = 1
+MAX_SENSOR_DELAY = 5000
+DEFAULT_SENSOR_DELAY = 100
+
+# If true, the sensor client also sends the device's location from
+# termux-location (using LOCATION_PROVIDER: "gps", "network" or "passive"),
+# so that the navigator can give directions that follow real roads. Can be
+# overridden with the SEND_LOCATION environment variable. The direction of
+# travel is only sent at speeds of at least MIN_BEARING_SPEED meters per
+# second
+SEND_LOCATION = False
+LOCATION_PROVIDER = "gps"
+MIN_BEARING_SPEED = 2
+
+# If true, the sensor client computes the heading itself and sends only the
+# most recent heading, at most HEADING_RATE times per second
+SEND_HEADING = False
+HEADING_RATE = 10
+
 GET_IP_TIMEOUT = 15
-GET_IP_ATTEMPT_INTERVAL = 1.5
-GET_IP_ATTEMPTS = 2
+
+# The UDP port on which the navigator answers sensor clients looking for it
+# on the local network; 0 disables discovery
+DISCOVERY_PORT = 9002
+# Sensor clients broadcast discovery queries to this address, and fall back
+# to GET_IP_URL if no navigator replies within DISCOVERY_TIMEOUT seconds
+DISCOVERY_ADDRESS = "255.255.255.255"
+DISCOVERY_TIMEOUT = 0.5
+
+# For this many seconds after connecting to an IP, reconnections try it
+# without waiting to get the IP again
+IP_CACHE_TTL = 300
 
 TIMEOUT = 2
-ATTEMPT_INTERVAL = 2
-ATTEMPTS = 4
+# Failed connections are retried after a random delay of up to RETRY_DELAY
+# seconds, which doubles after every failure, up to MAX_RETRY_DELAY
+RETRY_DELAY = 0.25
+MAX_RETRY_DELAY = 8
+
+MAX_FRAME_SIZE = 4096
+READ_SIZE = 4096
+
+# If the connection can't keep up with the sensors, at most SEND_QUEUE_SIZE
+# records wait to be sent (older ones are dropped), and writes wait once
+# SEND_BUFFER_SIZE bytes are buffered, so that what is sent stays fresh
+SEND_QUEUE_SIZE = 64
+SEND_BUFFER_SIZE = 8192
+
+# The port on which the sensor client serves metrics in the Prometheus text
+# format, on localhost only; 0 disables metrics
+METRICS_PORT = 9102
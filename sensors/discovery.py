@@ -0,0 +1,117 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Lets sensor clients find the navigator on the local network without going
+# through the local-ip web server. The client broadcasts a query over UDP,
+# and every navigator that receives it replies with the port of its sensor
+# server. The client uses the address of the first reply for its port.
+
+import asyncio
+import struct
+
+MAGIC = b"RDDS"
+QUERY = 0
+REPLY = 1
+# Magic, message type, sensor server port.
+MESSAGE = struct.Struct("<4sBH")
+# Queries are repeated this often (in seconds) in case they are lost.
+QUERY_INTERVAL = 0.1
+
+
+def decode_message(data):
+    try:
+        magic, kind, port = MESSAGE.unpack(data)
+    except struct.error:
+        return None
+    if magic != MAGIC:
+        return None
+    return kind, port
+
+
+class Responder(asyncio.DatagramProtocol):
+    def __init__(self, port):
+        self.port = port
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        message = decode_message(data)
+        if message is None or message[0] != QUERY:
+            return
+        self.transport.sendto(MESSAGE.pack(MAGIC, REPLY, self.port), addr)
+
+    def error_received(self, exc):
+        pass
+
+
+class Finder(asyncio.DatagramProtocol):
+    def __init__(self, port):
+        self.port = port
+        self.found = asyncio.get_event_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if decode_message(data) != (REPLY, self.port):
+            return
+        if not self.found.done():
+            self.found.set_result(addr[0])
+
+    def error_received(self, exc):
+        pass
+
+
+# Answers queries on `discovery_port` for a sensor server on `port` until
+# cancelled.
+async def serve(port, discovery_port, host="0.0.0.0"):
+    loop = asyncio.get_event_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: Responder(port), local_addr=(host, discovery_port),
+    )
+    try:
+        await loop.create_future()
+    finally:
+        transport.close()
+
+
+# Returns the IP of a navigator on the local network whose sensor server is
+# on `port`, or None if none replies within `timeout` seconds. Queries are
+# sent to `address`, usually a broadcast address.
+async def discover(port, discovery_port, timeout, address):
+    loop = asyncio.get_event_loop()
+    try:
+        transport, finder = await loop.create_datagram_endpoint(
+            lambda: Finder(port), local_addr=("0.0.0.0", 0),
+            allow_broadcast=True,
+        )
+    except OSError:
+        return None
+    query = MESSAGE.pack(MAGIC, QUERY, port)
+    end = loop.time() + timeout
+    try:
+        while loop.time() < end:
+            transport.sendto(query, (address, discovery_port))
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(finder.found),
+                    min(QUERY_INTERVAL, end - loop.time()),
+                )
+            except asyncio.TimeoutError:
+                continue
+        return None
+    finally:
+        transport.close()
@@ -0,0 +1,44 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+import math
+
+
+# Rotates `magnetism` by the smallest rotation that takes `gravity` to
+# (0, 0, 1) and returns the normalized horizontal component, or None if
+# there isn't one. This is the same projection that the navigator does with
+# math3d, written out so that it can run on the sensor client.
+def compute_heading(gravity, magnetism):
+    gx, gy, gz = gravity
+    mx, my, mz = magnetism
+    length = math.sqrt(gx * gx + gy * gy + gz * gz)
+    if length == 0:
+        return None
+    gx, gy, gz = gx / length, gy / length, gz / length
+
+    if gz <= -1:
+        # Gravity points straight down; math3d rotates about the y axis.
+        x, y = -mx, my
+    else:
+        cross = gy * mx - gx * my
+        x = mx * gz - gx * mz + gy * cross / (1 + gz)
+        y = my * gz - gy * mz - gx * cross / (1 + gz)
+
+    length = math.hypot(x, y)
+    if length == 0:
+        return None
+    return x / length, y / length
@@ -0,0 +1,59 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+
+
+# A bounded queue of sensor records between a producer and a slower
+# consumer. When it is full, new records push out the oldest ones, so the
+# consumer always gets the most recent data.
+class LatestQueue:
+    def __init__(self, max_size):
+        self.records = collections.deque(maxlen=max_size)
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    # Returns the number of records that were pushed out.
+    def put(self, records):
+        overflow = len(self.records) + len(records) - self.records.maxlen
+        overflow = max(overflow, 0)
+        self.dropped += overflow
+        self.records.extend(records)
+        if self.records:
+            self.ready.set()
+        return overflow
+
+    # Wakes up the consumer; `get_all` returns an empty list once the queue
+    # is closed and empty.
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    # Waits for records and returns all of them, oldest first.
+    async def get_all(self):
+        while not self.records and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        records = list(self.records)
+        self.records.clear()
+        self.ready.clear()
+        return records
@@ -0,0 +1,269 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+
+# Counters, gauges and histograms that can be served over HTTP in the
+# Prometheus text format.
+
+import asyncio
+import bisect
+import math
+import time
+
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10,
+)
+LOCALHOST = "127.0.0.1"
+REQUEST_TIMEOUT = 5
+MAX_REQUEST_SIZE = 8192
+LAG_INTERVAL = 0.25
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def escape(value):
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        if not self.labels:
+            self.values[()] = self.initial_value()
+
+    def initial_value(self):
+        return 0
+
+    def get(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("Expected labels {} for {}".format(
+                self.labels, self.name,
+            ))
+        key = tuple(str(labels[name]) for name in self.labels)
+        value = self.values.get(key)
+        if value is None:
+            value = self.values[key] = self.initial_value()
+        return key, value
+
+    def label_string(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{{{}}}".format(",".join(
+            '{}="{}"'.format(name, escape(value)) for name, value in pairs
+        ))
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for key in sorted(self.values):
+            lines += self.samples(key, self.values[key])
+        return lines
+
+    def samples(self, key, value):
+        return ["{}{} {}".format(
+            self.name, self.label_string(key), format_value(value),
+        )]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key, value = self.get(labels)
+        self.values[key] = value + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key, _ = self.get(labels)
+        self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key, value = self.get(labels)
+        self.values[key] = value + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class HistogramValue:
+    def __init__(self, bucket_count):
+        self.counts = [0] * bucket_count
+        self.sum = 0
+        self.count = 0
+
+
+class HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(
+            time.perf_counter() - self.start, **self.labels,
+        )
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, help, labels)
+
+    def initial_value(self):
+        return HistogramValue(len(self.buckets))
+
+    def observe(self, value, **labels):
+        _, histogram = self.get(labels)
+        histogram.counts[bisect.bisect_left(self.buckets, value)] += 1
+        histogram.sum += value
+        histogram.count += 1
+
+    # Context manager that observes the time spent in its body.
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def samples(self, key, value):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, value.counts):
+            total += count
+            lines.append("{}_bucket{} {}".format(
+                self.name,
+                self.label_string(key, [("le", format_value(bound))]),
+                total,
+            ))
+        labels = self.label_string(key)
+        lines.append("{}_sum{} {}".format(
+            self.name, labels, format_value(value.sum),
+        ))
+        lines.append("{}_count{} {}".format(self.name, labels, value.count))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def http_response(status, body, content_type="text/plain; charset=utf-8"):
+    body = body.encode("utf8")
+    header = "HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n"
+    header += "Connection: close\r\n\r\n"
+    return header.format(status, content_type, len(body)).encode() + body
+
+
+# Serves the metrics in `registry` at /metrics until cancelled.
+async def serve(registry, port, host=LOCALHOST):
+    async def on_connect(reader, writer):
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT,
+            )
+            method, path, *_ = request.decode("latin-1").split(" ", 2)
+            if method != "GET":
+                response = http_response("405 Method Not Allowed", "")
+            elif path.split("?", 1)[0] != "/metrics":
+                response = http_response("404 Not Found", "")
+            else:
+                response = http_response(
+                    "200 OK", registry.render(),
+                    "text/plain; version=0.0.4; charset=utf-8",
+                )
+            writer.write(response)
+            await writer.drain()
+        except (
+            asyncio.TimeoutError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError, ValueError, OSError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(
+        on_connect, host, port, limit=MAX_REQUEST_SIZE,
+    )
+    async with server:
+        await server.serve_forever()
+
+
+# Records how late the event loop wakes up from short sleeps, which shows how
+# long callbacks block the loop.
+async def monitor_loop_lag(histogram, interval=LAG_INTERVAL):
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0, loop.time() - start - interval))
+
+
+# Serves `registry` on `port` and records event loop lag in `lag_histogram`
+# until cancelled. If the server can't be started, `log` is called with the
+# error and only the lag is recorded. A port of 0 disables both.
+async def serve_with_lag(registry, lag_histogram, port, log):
+    if not port:
+        return
+    lag_task = asyncio.ensure_future(monitor_loop_lag(lag_histogram))
+    try:
+        await serve(registry, port)
+    except OSError as e:
+        log("Error starting metrics server: {}".format(e))
+        await lag_task
+    finally:
+        lag_task.cancel()
@@ -0,0 +1,158 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+from .config import MAX_FRAME_SIZE, MIN_BEARING_SPEED
+from .protocol import LOCATION, NO_BEARING, TIMESTAMP
+import json
+import re
+
+OPEN_BRACE = ord("{")
+CLOSE_BRACE = ord("}")
+QUOTE = ord('"')
+BACKSLASH = ord("\\")
+
+TOKEN_REGEX = re.compile(rb'[{}"\\]')
+TIMESTAMP_REGEX = re.compile(
+    rb'"' + TIMESTAMP.encode("utf8") + rb'"\s*:\s*([-+.0-9eE]+)',
+)
+
+
+def values_regex(name):
+    return re.compile(
+        rb'"' + re.escape(name.encode("utf8")) +
+        rb'"\s*:\s*\{[^{}]*?"values"\s*:\s*\[([^\]]*)\]',
+    )
+
+
+# Splits termux-sensor output into records that map sensor names to tuples of
+# values. Frames are found by brace depth rather than by formatting, garbage
+# between frames is skipped, and frames larger than `max_size` are dropped.
+# A TIMESTAMP field, as sent by the sensor client, is decoded too.
+class FrameParser:
+    def __init__(self, sensors, max_size=MAX_FRAME_SIZE):
+        self.regexes = [(name, values_regex(name)) for name in sensors]
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self.start = None
+        self.depth = 0
+        self.in_string = False
+        self.dropped = 0
+        self.invalid = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        records = []
+        pos = self.pos
+
+        while True:
+            match = TOKEN_REGEX.search(buffer, pos)
+            if match is None:
+                # `pos` can be past the end if the buffer ends with an
+                # escape character; the escaped byte is then skipped once it
+                # arrives.
+                pos = max(pos, len(buffer))
+                break
+            i = match.start()
+            char = buffer[i]
+            pos = i + 1
+
+            if self.in_string:
+                if char == BACKSLASH:
+                    pos += 1
+                elif char == QUOTE:
+                    self.in_string = False
+                continue
+
+            if char == OPEN_BRACE:
+                if self.depth == 0:
+                    self.start = i
+                self.depth += 1
+            elif self.depth == 0:
+                # Garbage between frames.
+                continue
+            elif char == QUOTE:
+                self.in_string = True
+            elif char == CLOSE_BRACE:
+                self.depth -= 1
+                if self.depth == 0:
+                    record = self.decode(buffer, self.start, pos)
+                    self.start = None
+                    if record:
+                        records.append(record)
+
+        if self.start is not None and len(buffer) - self.start > self.max_size:
+            self.dropped += 1
+            self.reset()
+            return records
+
+        consumed = min(pos, len(buffer)) if self.start is None else self.start
+        del buffer[:consumed]
+        self.pos = pos - consumed
+        if self.start is not None:
+            self.start -= consumed
+        return records
+
+    def reset(self):
+        self.buffer.clear()
+        self.pos = 0
+        self.start = None
+        self.depth = 0
+        self.in_string = False
+
+    def decode(self, buffer, start, end):
+        frame = bytes(buffer[start:end])
+        record = {}
+        for name, regex in self.regexes:
+            match = regex.search(frame)
+            if match is None:
+                continue
+            try:
+                record[name] = tuple(map(float, match[1].split(b",")))
+            except ValueError:
+                self.invalid += 1
+                return None
+        match = TIMESTAMP_REGEX.search(frame)
+        if record and match is not None:
+            try:
+                record[TIMESTAMP] = float(match[1])
+            except ValueError:
+                pass
+        return record
+
+
+# Splits termux-location output into records with a LOCATION. The bearing
+# is only used when the speed is at least MIN_BEARING_SPEED, as it is
+# meaningless when standing still.
+class LocationParser(FrameParser):
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        super().__init__([], max_size)
+
+    def decode(self, buffer, start, end):
+        try:
+            data = json.loads(bytes(buffer[start:end]))
+            latitude = float(data["latitude"])
+            longitude = float(data["longitude"])
+            bearing = float(data.get("bearing", NO_BEARING))
+            speed = float(data.get("speed", 0))
+        except (ValueError, TypeError, KeyError):
+            self.invalid += 1
+            return None
+        if speed < MIN_BEARING_SPEED:
+            bearing = NO_BEARING
+        return {LOCATION: (latitude, longitude, bearing)}
@@ -0,0 +1,192 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+from .config import MAGNETOMETER, GRAVITY
+import asyncio
+import json
+import struct
+
+VERSION_JSON = 0
+VERSION_BINARY = 1
+MAX_VERSION = VERSION_BINARY
+
+# Sent by the client right after connecting: magic, highest supported
+# version, length of the session ID, followed by the UTF-8 session ID. The
+# server replies with the same structure containing the version that will be
+# used and an empty session ID. Clients that send JSON right away get
+# VERSION_JSON and DEFAULT_SESSION.
+MAGIC = b"RDIR"
+HELLO = struct.Struct("<4sBB")
+MAX_HELLO_SIZE = HELLO.size + 255
+DEFAULT_SESSION = "default"
+
+# Sync byte, sensor ID, timestamp, three values.
+FRAME = struct.Struct("<BBdfff")
+FRAME_SYNC = 0xa5
+
+# Not a real sensor; sent by clients that compute the heading themselves.
+# The values are the x and y components of the heading, and 0.
+HEADING = "Heading"
+
+# Not a real sensor either; sent by clients with SEND_LOCATION set. The
+# values are the latitude and longitude in degrees, and the bearing (the
+# direction of travel in degrees clockwise from north), or NO_BEARING if it
+# isn't known. In binary frames, the coordinates are precise to about a
+# meter.
+LOCATION = "Location"
+NO_BEARING = -1
+
+SENSOR_IDS = {
+    MAGNETOMETER: 1,
+    GRAVITY: 2,
+    HEADING: 3,
+    LOCATION: 4,
+}
+
+SENSOR_NAMES = {id: name for name, id in SENSOR_IDS.items()}
+
+# Key in decoded records that holds the client's timestamp of the sample, if
+# known.
+TIMESTAMP = "timestamp"
+
+
+# Records that contain TIMESTAMP are sent with that timestamp instead of
+# `timestamp`.
+def encode_records(records, timestamp=None):
+    return b"".join(
+        FRAME.pack(
+            FRAME_SYNC, SENSOR_IDS[name], record.get(TIMESTAMP, timestamp),
+            *values,
+        )
+        for record in records
+        for name, values in record.items() if name != TIMESTAMP
+    )
+
+
+# Encodes records in the format of termux-sensor, for VERSION_JSON, with
+# TIMESTAMP (if present) as an extra top-level field.
+def encode_json_records(records):
+    return b"".join(
+        json.dumps({
+            name: value if name == TIMESTAMP else {"values": list(value)}
+            for name, value in record.items()
+        }).encode() + b"\n"
+        for record in records
+    )
+
+
+def encode_heading(heading, timestamp):
+    x, y = heading
+    return FRAME.pack(FRAME_SYNC, SENSOR_IDS[HEADING], timestamp, x, y, 0)
+
+
+def encode_hello(version, session_id=""):
+    session_id = session_id.encode("utf8")[:255]
+    return HELLO.pack(MAGIC, version, len(session_id)) + session_id
+
+
+async def send_hello(reader, writer, timeout, max_version, session_id):
+    writer.write(encode_hello(max_version, session_id))
+    await writer.drain()
+    try:
+        reply = await asyncio.wait_for(
+            reader.readexactly(HELLO.size), timeout=timeout,
+        )
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return VERSION_JSON
+    magic, version, length = HELLO.unpack(reply)
+    if magic != MAGIC or version > max_version:
+        return VERSION_JSON
+    await reader.readexactly(length)
+    return version
+
+
+# Returns the session ID in the hello message at the start of `data`, or None
+# if `data` is too short to tell. Doesn't consume anything, so it can be used
+# on data that was read with MSG_PEEK.
+def peek_session_id(data):
+    if len(data) < HELLO.size:
+        return None if MAGIC.startswith(data[:len(MAGIC)]) else DEFAULT_SESSION
+    magic, _, length = HELLO.unpack_from(data)
+    if magic != MAGIC:
+        return DEFAULT_SESSION
+    if len(data) < HELLO.size + length:
+        return None
+    session_id = data[HELLO.size:HELLO.size + length].decode("utf8", "replace")
+    return session_id or DEFAULT_SESSION
+
+
+# Returns the negotiated version, the session ID, and any bytes that were
+# read but are not part of the hello message.
+async def accept_hello(reader, writer):
+    data = await reader.read(1)
+    if data != MAGIC[:1]:
+        return VERSION_JSON, DEFAULT_SESSION, data
+    data += await reader.readexactly(HELLO.size - 1)
+    magic, version, length = HELLO.unpack(data)
+    if magic != MAGIC:
+        return VERSION_JSON, DEFAULT_SESSION, data
+    session_id = (await reader.readexactly(length)).decode("utf8", "replace")
+    version = min(version, MAX_VERSION)
+    writer.write(encode_hello(version))
+    await writer.drain()
+    return version, session_id or DEFAULT_SESSION, b""
+
+
+# Decodes binary frames into the same records that FrameParser produces.
+# `groups` is a list of lists of sensor names. Frames are collected until
+# every sensor in one of the groups has been seen, and are then emitted
+# together as a single record; frames from other groups keep waiting.
+class BinaryParser:
+    def __init__(self, groups):
+        self.groups = [set(group) for group in groups]
+        self.sensors = set().union(*self.groups)
+        self.buffer = bytearray()
+        self.pending = {}
+        self.timestamp = None
+        self.invalid = 0
+        self.dropped = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        records = []
+        pos = 0
+
+        while len(buffer) - pos >= FRAME.size:
+            sync, id, timestamp, *values = FRAME.unpack_from(buffer, pos)
+            name = SENSOR_NAMES.get(id)
+            if sync != FRAME_SYNC or name is None:
+                self.invalid += 1
+                pos = buffer.find(FRAME_SYNC, pos + 1)
+                if pos < 0:
+                    pos = len(buffer)
+                continue
+            pos += FRAME.size
+            if name not in self.sensors:
+                continue
+            self.pending[name] = tuple(values)
+            self.timestamp = timestamp
+            for group in self.groups:
+                if group.issubset(self.pending):
+                    record = {name: self.pending.pop(name) for name in group}
+                    record[TIMESTAMP] = timestamp
+                    records.append(record)
+                    break
+
+        del buffer[:pos]
+        return records
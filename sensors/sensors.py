@@ -18,26 +18,59 @@
 from .config import (
     GET_IP_TIMEOUT,
     GET_IP_URL,
-    GET_IP_ATTEMPT_INTERVAL,
-    GET_IP_ATTEMPTS,
+    IP_CACHE_TTL,
+
+    DISCOVERY_PORT,
+    DISCOVERY_ADDRESS,
+    DISCOVERY_TIMEOUT,
 
     PORT,
     TIMEOUT,
-    ATTEMPT_INTERVAL,
-    ATTEMPTS,
+    RETRY_DELAY,
+    MAX_RETRY_DELAY,
 
     MAGNETOMETER,
     GRAVITY,
+    PROTOCOL,
+    SENSOR_SOURCE,
+    SENSOR_DELAY,
+    MIN_SENSOR_DELAY,
+    MAX_SENSOR_DELAY,
+    DEFAULT_SENSOR_DELAY,
+    SESSION_ID,
+    SEND_HEADING,
+    HEADING_RATE,
+    SEND_LOCATION,
+    SEND_QUEUE_SIZE,
+    SEND_BUFFER_SIZE,
+
+    METRICS_PORT,
 )
 
+from . import discovery
+from . import metrics
+from .heading import compute_heading
+from .latest import LatestQueue
+from .parser import FrameParser, LocationParser
+from .protocol import VERSION_BINARY, VERSION_JSON, HEADING, TIMESTAMP
+from .protocol import encode_heading, encode_json_records, encode_records
+from .protocol import send_hello
+from .sources import LOCATION_SOURCES, SOURCES
 import asyncio
 import aiohttp
+import math
 import os
+import random
 import signal
-import subprocess
+import socket
 import sys
+import time
 
 DEBUG = bool(os.environ.get("DEBUG"))
+SOURCE = os.environ.get("SENSOR_SOURCE") or SENSOR_SOURCE
+DELAY = float(os.environ.get("SENSOR_DELAY") or 0) or SENSOR_DELAY
+LOCATION_ENABLED = bool(os.environ.get("SEND_LOCATION")) or SEND_LOCATION
+SENSORS = [MAGNETOMETER, GRAVITY]
 
 
 def log(*args, **kwargs):
@@ -46,114 +79,433 @@ def log(*args, **kwargs):
         print(*args, **kwargs)
 
 
+METRICS = metrics.Registry()
+RECORDS_SENT = METRICS.counter(
+    "sensors_records_sent_total", "Sensor records sent",
+)
+LOCATIONS_SENT = METRICS.counter(
+    "sensors_locations_sent_total", "Locations sent",
+)
+BYTES_SENT = METRICS.counter("sensors_bytes_sent_total", "Bytes sent")
+PARSE_TIME = METRICS.histogram(
+    "sensors_parse_seconds", "Time spent parsing each chunk of sensor output",
+)
+FRAMES_DROPPED = METRICS.counter(
+    "sensors_frames_dropped_total",
+    "Sensor frames dropped because they were oversized or invalid, or "
+    "because the connection couldn't keep up (backlog)", ["reason"],
+)
+SEND_QUEUE = METRICS.gauge(
+    "sensors_send_queue_records", "Sensor records waiting to be sent",
+)
+CONNECTION_ATTEMPTS = METRICS.counter(
+    "sensors_connection_attempts_total", "Attempts to connect to the server",
+)
+CONNECTIONS = METRICS.counter(
+    "sensors_connections_total",
+    "Connections established to the server, including reconnections",
+)
+IP_LOOKUPS = METRICS.counter(
+    "sensors_ip_lookups_total",
+    "Server IPs found, by method (LAN discovery or HTTP)",
+    ["method"],
+)
+CONNECT_TIME = METRICS.histogram(
+    "sensors_connect_seconds",
+    "Time taken to connect to the server, including getting its IP",
+)
+LOOP_LAG = METRICS.histogram(
+    "sensors_loop_lag_seconds", "Delay in waking up the event loop",
+)
+
+
+# Like `FrameParser.feed`, but records metrics.
+def parse(parser, data):
+    dropped, invalid = parser.dropped, parser.invalid
+    with PARSE_TIME.time():
+        records = parser.feed(data)
+    if parser.dropped > dropped:
+        FRAMES_DROPPED.inc(parser.dropped - dropped, reason="oversized")
+    if parser.invalid > invalid:
+        FRAMES_DROPPED.inc(parser.invalid - invalid, reason="invalid")
+    return records
+
+
+# Runs `coroutines` until one of them finishes, then cancels the others.
+async def run_until_first(*coroutines):
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        done, _ = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        for task in tasks:
+            task.cancel()
+    for task in done:
+        task.result()
+
+
+def make_source():
+    if SOURCE not in SOURCES:
+        raise ValueError("Unknown sensor source: {}".format(SOURCE))
+    return SOURCES[SOURCE](SENSORS, DELAY)
+
+
+def make_location_source():
+    if not LOCATION_ENABLED:
+        return None
+    return LOCATION_SOURCES[SOURCE]()
+
+
+# `source` defaults to the one given by SENSOR_SOURCE and SENSOR_DELAY.
+# `location_source` defaults to the one for SENSOR_SOURCE if SEND_LOCATION
+# is set, and is otherwise None.
 class Client:
-    def __init__(self):
+    def __init__(self, source=None, location_source=None):
+        self.source = make_source() if source is None else source
+        self.location_source = location_source
+        if source is None and location_source is None:
+            self.location_source = make_location_source()
         self.reader = None
         self.writer = None
         self.dest_ip = None
-        self.sensor_proc = None
+        # Monotonic time at which `dest_ip` was last connected to.
+        self.dest_ip_time = -math.inf
+        self.http = None
+        self.failures = 0
+        self.version = VERSION_JSON
+        self.heading = None
+        self.heading_ready = asyncio.Event()
+        self.delay_lock = asyncio.Lock()
+
+    # Multiplies the sensor delay by `factor`, within MIN_SENSOR_DELAY and
+    # MAX_SENSOR_DELAY. The source is changed while it is running.
+    async def change_delay(self, factor):
+        async with self.delay_lock:
+            delay = self.source.delay
+            if delay is None:
+                delay = DEFAULT_SENSOR_DELAY
+            delay = min(
+                max(delay * factor, MIN_SENSOR_DELAY), MAX_SENSOR_DELAY,
+            )
+            log("Sensor delay: {:g} ms".format(delay))
+            await self.source.set_delay(delay)
 
     async def start(self):
-        while True:
-            await self.update_dest_ip()
-            if not (await self.try_establish_connection()):
-                continue
-            await self.clean_up_sensors()
-            await self.read_sensors()
+        try:
+            while True:
+                if not (await self.try_establish_connection()):
+                    await self.wait_to_retry()
+                    continue
+                await self.source.clean_up()
+                await self.read_sensors()
+        finally:
+            if self.http is not None:
+                await self.http.close()
 
-    async def clean_up_sensors(self):
-        proc = await asyncio.create_subprocess_exec("termux-sensor", "-c")
-        await proc.wait()
+    # Waits a random delay (for "full jitter" exponential backoff).
+    async def wait_to_retry(self):
+        delay = min(RETRY_DELAY * 2 ** self.failures, MAX_RETRY_DELAY)
+        self.failures += 1
+        await asyncio.sleep(random.uniform(0, delay))
 
     async def read_sensors(self):
-        self.sensor_proc = await asyncio.create_subprocess_exec(
-            "termux-sensor", "-s", "{},{}".format(MAGNETOMETER, GRAVITY),
-            stdout=subprocess.PIPE, start_new_session=True,
-        )
+        await self.source.start()
+        location_task = None
+        if self.location_source is not None:
+            location_task = asyncio.ensure_future(self.forward_locations())
+        try:
+            if SEND_HEADING:
+                await self.send_headings()
+            else:
+                await self.forward_sensors()
+        except OSError as e:
+            log("Connection lost: {}".format(e))
+        finally:
+            if location_task is not None:
+                location_task.cancel()
+                await asyncio.gather(location_task, return_exceptions=True)
+            self.writer.close()
+            log("Stopping sensor source")
+            await self.source.stop()
+            log("Sensor source stopped")
+
+    # Locations are rare compared to sensor samples, so each one is sent as
+    # soon as it is read, leaving flow control to the sensor data that is
+    # sent on the same connection. If the location source stops, sensor
+    # data is still sent.
+    async def forward_locations(self):
+        source = self.location_source
+        parser = LocationParser()
+        await source.start()
         try:
             while True:
-                data = await self.sensor_proc.stdout.read(1024)
+                data = await source.read()
+                if not data:
+                    log("Location source stopped")
+                    return
+                records = parse(parser, data)
+                if not records:
+                    continue
+                timestamp = time.time()
+                for record in records:
+                    record[TIMESTAMP] = timestamp
+                if self.version == VERSION_BINARY:
+                    data = encode_records(records)
+                else:
+                    data = encode_json_records(records)
                 log("Sending", data)
                 self.writer.write(data)
-                await self.writer.drain()
+                LOCATIONS_SENT.inc(len(records))
+                BYTES_SENT.inc(len(data))
         except OSError as e:
-            log("Connection lost: {}".format(e))
+            log("Error sending location: {}".format(e))
         finally:
-            await self.kill_sensor_proc()
+            await source.stop()
 
-    async def kill_sensor_proc(self):
-        proc = self.sensor_proc
-        self.sensor_proc = None
-        if proc is None:
-            return
-        if proc.returncode is not None:
-            return
-        pgid = os.getpgid(proc.pid)
-        os.killpg(pgid, signal.SIGHUP)
-        log("Terminating sensor process")
-        await proc.wait()
-        log("Sensor process terminated")
+    # Sensor output is read continuously, even while sending is blocked, so
+    # it never backs up. Only the most recent SEND_QUEUE_SIZE records wait
+    # to be sent.
+    async def forward_sensors(self):
+        queue = LatestQueue(SEND_QUEUE_SIZE)
+        try:
+            await run_until_first(
+                self.read_records(queue), self.write_records(queue),
+            )
+        finally:
+            SEND_QUEUE.dec(len(queue))
+
+    # Partial records are held back until the rest arrives. Records are
+    # timestamped when they are read.
+    async def read_records(self, queue):
+        parser = FrameParser(SENSORS)
+        while True:
+            data = await self.source.read()
+            if not data:
+                log("Sensor source stopped")
+                return
+            timestamp = time.time()
+            records = parse(parser, data)
+            for record in records:
+                record[TIMESTAMP] = timestamp
+            dropped = queue.put(records)
+            SEND_QUEUE.inc(len(records) - dropped)
+            if dropped:
+                FRAMES_DROPPED.inc(dropped, reason="backlog")
+
+    # Sends all the records that are waiting together.
+    async def write_records(self, queue):
+        while True:
+            records = await queue.get_all()
+            SEND_QUEUE.dec(len(records))
+            if self.version == VERSION_BINARY:
+                data = encode_records(records)
+            else:
+                data = encode_json_records(records)
+            log("Sending", data)
+            RECORDS_SENT.inc(len(records))
+            self.writer.write(data)
+            BYTES_SENT.inc(len(data))
+            await self.writer.drain()
+
+    async def send_headings(self):
+        await run_until_first(self.read_headings(), self.write_headings())
+
+    async def read_headings(self):
+        parser = FrameParser(SENSORS)
+        self.heading = None
+        self.heading_ready.clear()
+        while True:
+            data = await self.source.read()
+            if not data:
+                log("Sensor source stopped")
+                return
+            for record in parse(parser, data):
+                try:
+                    heading = compute_heading(
+                        record[GRAVITY], record[MAGNETOMETER],
+                    )
+                except (KeyError, ValueError):
+                    continue
+                if heading is None:
+                    continue
+                # Overwrites any heading that hasn't been sent yet.
+                self.heading = (heading, time.time())
+                self.heading_ready.set()
 
+    async def write_headings(self):
+        while True:
+            await self.heading_ready.wait()
+            self.heading_ready.clear()
+            heading, timestamp = self.heading
+            if self.version == VERSION_BINARY:
+                data = encode_heading(heading, timestamp)
+            else:
+                x, y = heading
+                data = encode_json_records([
+                    {HEADING: (x, y, 0), TIMESTAMP: timestamp},
+                ])
+            log("Sending", data)
+            self.writer.write(data)
+            RECORDS_SENT.inc()
+            BYTES_SENT.inc(len(data))
+            await self.writer.drain()
+            await asyncio.sleep(1 / HEADING_RATE)
+
+    # Tries to connect to the IP that was last connected to, if that was
+    # less than IP_CACHE_TTL seconds ago, while finding the current IP, and
+    # to the current IP as soon as it is known (if it's different). The
+    # first connection to succeed is used. If finding the IP fails, the last
+    # IP is tried regardless of its age.
     async def try_establish_connection(self):
         log("Attempting to connect")
-        attempts = 0
-        while attempts < ATTEMPTS:
-            if attempts > 0:
-                await asyncio.sleep(ATTEMPT_INTERVAL)
-            attempts += 1
-            future = asyncio.open_connection(self.dest_ip, PORT)
-
-            try:
-                self.reader, self.writer = await asyncio.wait_for(
-                    future, timeout=TIMEOUT,
+        start = time.monotonic()
+        attempts = {}
+        get_ip = asyncio.ensure_future(self.find_ip())
+        pending = {get_ip}
+
+        def attempt(ip):
+            if ip and ip not in attempts:
+                attempts[ip] = asyncio.ensure_future(self.try_connect(ip))
+                pending.add(attempts[ip])
+
+        if time.monotonic() - self.dest_ip_time < IP_CACHE_TTL:
+            attempt(self.dest_ip)
+        connections = []
+        try:
+            while pending and not connections:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED,
                 )
-            except asyncio.TimeoutError:
-                log("Connection timeout")
-                continue
-            except OSError as e:
-                log("Error creating connection: {}".format(e))
-                continue
-            log("Connected")
-            return True
-        return False
-
-    async def update_dest_ip(self):
-        log("Attempting to get IP")
-        attempts = 0
-        while attempts < GET_IP_ATTEMPTS or not self.dest_ip:
-            if attempts > 0:
-                await asyncio.sleep(GET_IP_ATTEMPT_INTERVAL)
-            attempts += 1
-
-            try:
-                dest_ip = await self.try_get_ip()
-            except aiohttp.ClientError as e:
-                log("Client error: {}".format(e))
-                continue
-            if not dest_ip:
-                continue
-            self.dest_ip = dest_ip
-            log("Got IP")
-            break
+                if get_ip in done:
+                    attempt(get_ip.result() or self.dest_ip)
+                connections += [
+                    (ip, task.result()) for ip, task in attempts.items()
+                    if task in done and task.result() is not None
+                ]
+        finally:
+            for task in pending:
+                task.cancel()
+        if not connections:
+            return False
+
+        (ip, (self.reader, self.writer)), *others = connections
+        for _, (_, writer) in others:
+            writer.close()
+        log("Connected to {}".format(ip))
+        self.dest_ip = ip
+        self.dest_ip_time = time.monotonic()
+        self.failures = 0
+        CONNECTIONS.inc()
+        CONNECT_TIME.observe(time.monotonic() - start)
+        self.limit_buffering()
+        await self.negotiate()
+        return True
+
+    # Makes a single attempt to connect to `ip`. Returns (reader, writer),
+    # or None if the attempt failed.
+    async def try_connect(self, ip):
+        CONNECTION_ATTEMPTS.inc()
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(ip, PORT), timeout=TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            log("Connection timeout: {}".format(ip))
+        except OSError as e:
+            log("Error creating connection: {}".format(e))
+        return None
+
+    # Keeps data from waiting in buffers when the connection is slow. Where
+    # supported, TCP_NOTSENT_LOWAT limits the data waiting in the kernel
+    # without limiting the data in flight; otherwise, the whole send buffer
+    # is limited.
+    def limit_buffering(self):
+        self.writer.transport.set_write_buffer_limits(SEND_BUFFER_SIZE)
+        sock = self.writer.get_extra_info("socket")
+        if sock is None:
+            return
+        option = (socket.SOL_SOCKET, socket.SO_SNDBUF)
+        if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+            option = (socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT)
+        try:
+            sock.setsockopt(*option, SEND_BUFFER_SIZE)
+        except OSError as e:
+            log("Error limiting send buffer: {}".format(e))
+
+    async def negotiate(self):
+        self.version = VERSION_JSON
+        max_version = VERSION_BINARY if PROTOCOL == "binary" else VERSION_JSON
+        try:
+            self.version = await send_hello(
+                self.reader, self.writer, TIMEOUT, max_version, SESSION_ID,
+            )
+        except OSError as e:
+            log("Error negotiating protocol: {}".format(e))
+        log("Protocol version: {}".format(self.version))
+
+    # Looks for the navigator on the local network, and gets its IP from
+    # GET_IP_URL if it isn't found.
+    async def find_ip(self):
+        if DISCOVERY_PORT:
+            ip = await discovery.discover(
+                PORT, DISCOVERY_PORT, DISCOVERY_TIMEOUT, DISCOVERY_ADDRESS,
+            )
+            if ip is not None:
+                log("Discovered IP")
+                IP_LOOKUPS.inc(method="discovery")
+                return ip
+        ip = await self.try_get_ip()
+        if ip is not None:
+            IP_LOOKUPS.inc(method="http")
+        return ip
+
+    # The HTTP session is kept open so that its connections (and TLS
+    # sessions) are reused.
+    def http_session(self):
+        if self.http is None or self.http.closed:
+            timeout = aiohttp.ClientTimeout(total=GET_IP_TIMEOUT)
+            self.http = aiohttp.ClientSession(timeout=timeout)
+        return self.http
 
     async def try_get_ip(self):
-        timeout = aiohttp.ClientTimeout(total=GET_IP_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(GET_IP_URL) as resp:
+        log("Attempting to get IP")
+        try:
+            async with self.http_session().get(GET_IP_URL) as resp:
                 if resp.status != 200:
-                    log("Bad response status: {}".format(resp.status)),
+                    log("Bad response status: {}".format(resp.status))
                     return None
                 text = ((await resp.text()) or "").strip()
-                if not text:
-                    log("Warning: Empty response")
-                    return None
-                return text
+        except aiohttp.ClientError as e:
+            log("Client error: {}".format(e))
+            return None
+        except asyncio.TimeoutError:
+            log("Timed out getting IP")
+            return None
+        if not text:
+            log("Warning: Empty response")
+            return None
+        log("Got IP")
+        return text
+
+
+# Serves METRICS and measures event loop lag until cancelled.
+async def serve_metrics():
+    await metrics.serve_with_lag(METRICS, LOOP_LAG, METRICS_PORT, log)
 
 
 def run():
     loop = asyncio.get_event_loop()
     client = Client()
+
+    def change_delay(factor):
+        asyncio.ensure_future(client.change_delay(factor))
+
+    loop.add_signal_handler(signal.SIGUSR1, change_delay, 2)
+    loop.add_signal_handler(signal.SIGUSR2, change_delay, 0.5)
     try:
-        loop.run_until_complete(client.start())
+        loop.run_until_complete(asyncio.gather(
+            client.start(), serve_metrics(),
+        ))
     finally:
-        subprocess.run(["termux-sensor", "-c"])
+        loop.run_until_complete(client.source.clean_up())
@@ -0,0 +1,219 @@
+# Copyright (C) 2019 taylor.fish <contact@taylor.fish>
+#
+# This file is part of random-directions.
+#
+# random-directions is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# random-directions is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with random-directions. If not, see <https://www.gnu.org/licenses/>.
+
+# Where the sensor client gets its sensor data. Every source produces output
+# in the format of termux-sensor, with one sample of every sensor every
+# `delay` milliseconds (or at the source's default rate if `delay` is None).
+# `read` returns the next chunk of output, or b"" once the source has
+# stopped. Location sources work the same way, but produce output in the
+# format of termux-location.
+
+from .config import MAGNETOMETER, GRAVITY, LOCATION_PROVIDER, READ_SIZE
+import asyncio
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import time
+
+SYNTHETIC_DELAY = 100
+SYNTHETIC_TURN_RATE = math.pi / 30
+SYNTHETIC_NOISE = 0.5
+MAGNETISM = 40
+GRAVITY_VALUES = (0.0, 0.0, 9.81)
+# The synthetic vehicle starts here and drives north at SYNTHETIC_SPEED
+# meters per second, with a location every SYNTHETIC_LOCATION_INTERVAL
+# seconds.
+SYNTHETIC_START = (47.6, -122.3)
+SYNTHETIC_SPEED = 10
+SYNTHETIC_LOCATION_INTERVAL = 1
+METERS_PER_DEGREE = 111195
+
+
+class TermuxSource:
+    def __init__(self, sensors, delay=None):
+        self.sensors = sensors
+        self.delay = delay
+        self.proc = None
+        # Resolved when a restart in progress has finished.
+        self.restart = None
+
+    # Stops any sensor readings left over from a previous process.
+    async def clean_up(self):
+        proc = await asyncio.create_subprocess_exec("termux-sensor", "-c")
+        await proc.wait()
+
+    async def start(self):
+        args = ["termux-sensor", "-s", ",".join(self.sensors)]
+        if self.delay is not None:
+            args += ["-d", str(round(self.delay))]
+        self.proc = await asyncio.create_subprocess_exec(
+            *args, stdout=subprocess.PIPE, start_new_session=True,
+        )
+
+    # A read that is pending while the process is restarted continues with
+    # the new process instead of returning b"".
+    async def read(self):
+        while True:
+            proc = self.proc
+            if proc is not None:
+                data = await proc.stdout.read(READ_SIZE)
+                if data:
+                    return data
+            if self.restart is not None:
+                await self.restart
+            elif self.proc is proc:
+                return b""
+
+    async def stop(self):
+        proc = self.proc
+        self.proc = None
+        if proc is None:
+            return
+        if proc.returncode is not None:
+            return
+        pgid = os.getpgid(proc.pid)
+        os.killpg(pgid, signal.SIGHUP)
+        await proc.wait()
+
+    # termux-sensor can't change its delay while running, so it is
+    # restarted.
+    async def set_delay(self, delay):
+        self.delay = delay
+        if self.proc is None:
+            return
+        self.restart = asyncio.get_event_loop().create_future()
+        try:
+            await self.stop()
+            await self.start()
+        finally:
+            self.restart.set_result(None)
+            self.restart = None
+
+
+# Generates samples from a phone lying flat in a vehicle that turns
+# steadily, with some noise. Output for every sample that is due is returned
+# at once, so high rates work even when the event loop is slow to wake up.
+class SyntheticSource:
+    def __init__(self, sensors, delay=None):
+        self.sensors = sensors
+        self.delay = SYNTHETIC_DELAY if delay is None else delay
+        self.start_time = None
+        self.count = 0
+
+    async def clean_up(self):
+        pass
+
+    async def start(self):
+        self.start_time = time.monotonic()
+        self.count = 0
+
+    def sample(self, seq):
+        angle = seq * self.delay / 1000 * SYNTHETIC_TURN_RATE
+        values = {
+            MAGNETOMETER: [
+                MAGNETISM * math.cos(angle), MAGNETISM * math.sin(angle), 0,
+            ],
+            GRAVITY: list(GRAVITY_VALUES),
+        }
+        return {
+            name: {"values": [
+                v + random.gauss(0, SYNTHETIC_NOISE) for v in values[name]
+            ]}
+            for name in self.sensors if name in values
+        }
+
+    async def read(self):
+        if self.start_time is None:
+            return b""
+        elapsed = time.monotonic() - self.start_time
+        due = int(elapsed * 1000 / self.delay) + 1
+        if due <= self.count:
+            await asyncio.sleep(
+                self.count * self.delay / 1000 - elapsed,
+            )
+            due = self.count + 1
+        samples = range(self.count, due)
+        self.count = due
+        return "".join(
+            json.dumps(self.sample(seq), indent=2) + "\n" for seq in samples
+        ).encode()
+
+    async def stop(self):
+        self.start_time = None
+
+    async def set_delay(self, delay):
+        if self.start_time is not None:
+            # Keeps the samples that have already been produced in place.
+            self.start_time += self.count * (self.delay - delay) / 1000
+        self.delay = delay
+
+
+class TermuxLocation(TermuxSource):
+    def __init__(self, provider=LOCATION_PROVIDER):
+        super().__init__([])
+        self.provider = provider
+
+    async def clean_up(self):
+        pass
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            "termux-location", "-p", self.provider, "-r", "updates",
+            stdout=subprocess.PIPE, start_new_session=True,
+        )
+
+
+class SyntheticLocation:
+    def __init__(self):
+        self.start_time = None
+
+    async def clean_up(self):
+        pass
+
+    async def start(self):
+        self.start_time = time.monotonic()
+
+    async def read(self):
+        if self.start_time is None:
+            return b""
+        await asyncio.sleep(SYNTHETIC_LOCATION_INTERVAL)
+        distance = (time.monotonic() - self.start_time) * SYNTHETIC_SPEED
+        latitude, longitude = SYNTHETIC_START
+        return json.dumps({
+            "latitude": latitude + distance / METERS_PER_DEGREE,
+            "longitude": longitude,
+            "bearing": 0.0,
+            "speed": float(SYNTHETIC_SPEED),
+            "provider": "synthetic",
+        }, indent=2).encode() + b"\n"
+
+    async def stop(self):
+        self.start_time = None
+
+
+SOURCES = {
+    "termux": TermuxSource,
+    "synthetic": SyntheticSource,
+}
+
+LOCATION_SOURCES = {
+    "termux": TermuxLocation,
+    "synthetic": SyntheticLocation,
+}